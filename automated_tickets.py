@@ -17,337 +17,487 @@ matching the requested schedule.
 
 # parse command line arguments, 'sys.argv'
 import argparse
+import atexit
+import datetime
 import logging
 import logging.handlers
 import os
 import os.path
+import queue
 import sys
+import time
 
+# Used to report how long each step of starting up takes. Startup happens
+# on every cron invocation, so it is worth keeping an eye on.
+startup_started = time.perf_counter()
+startup_times = {}
 
-app_name = 'automated-tickets'
-
-# TODO: Configure formatter to log function/class info
-syslog_formatter = logging.Formatter('%(name)s - %(levelname)s - %(funcName)s - %(message)s')
-file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s')
-stdout_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s')
-
-# Grab root logger and set initial logging level
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
-
-# The SysLogHandler class, supports sending logging messages to a remote
-# or local Unix syslog.
-# TODO: Expose this value elsewhere; move to logging_config.json?
-syslog_socket = '/dev/log'
-try:
-    syslog_handler = logging.handlers.SysLogHandler(address=syslog_socket)
-except AttributeError:
-    # We're likely running on Windows, so use the NullHandler here
-    syslog_handler = logging.NullHandler
-else:
-    # Good thus far, finish configuring SysLogHandler
-    syslog_handler.ident = app_name + ": "
-    syslog_handler.setFormatter(syslog_formatter)
-    syslog_handler.setLevel(logging.INFO)
-
-console_handler = logging.StreamHandler(stream=sys.stdout)
-console_handler.setFormatter(stdout_formatter)
-# Apply lax logging level since we will use a filter to examine message levels
-# and compare against allowed levels set within the main config file. This
-# filter is added later once the settings config object has been constructed.
-console_handler.setLevel(logging.NOTSET)
-
-file_handler = logging.FileHandler(app_name + '.log', mode='a')
-file_handler.setFormatter(file_formatter)
-file_handler.setLevel(logging.DEBUG)
-
-# Create logger object that inherits from root and will be inherited by
-# all modules used by this project
-# Note: The console_handler is added later after the settings config object
-# has been constructed.
-app_logger = logging.getLogger(app_name)
-app_logger.addHandler(syslog_handler)
-app_logger.addHandler(file_handler)
-app_logger.setLevel(logging.DEBUG)
-
-log = app_logger.getChild(__name__)
-
-log.debug("Logging initialized for %s", __name__)
+
+def mark_startup_step(step):
+
+    """
+    Record the time taken since the previous startup step
+    """
+
+    global startup_started
+
+    now = time.perf_counter()
+    startup_times[step] = round(now - startup_started, 6)
+    startup_started = now
 
 
 # TODO: Setup support for reading in environmental variable value
 # in place of hard-coding values here.
 #
+# NOTE: The library defers importing the database driver and other slow
+# modules until they are needed, so --help and argument validation stay fast.
 import automated_tickets_lib as atlib
 ##########################################################################
 
+mark_startup_step('library_import')
+
+
+def main():
+
+    """
+    Run the script. Nothing is run when this module is imported, which
+    happens in every worker process started by the render pool.
+    """
 
-log.debug("Finished importing standard modules and our custom library modules.")
+    ########################################################
+    # Collect command-line arguments passed by Cron
+    ########################################################
 
-########################################################
-# Collect command-line arguments passed by Cron
-########################################################
+    parser = argparse.ArgumentParser(
+        description='Check for applicable events and generate notices for matches'
+        )
+
+    # One or more event schedules may be requested. The events for all requested
+    # schedules are retrieved with a single query and processed in one run.
+    parser.add_argument(
+        '--event_schedule',
+        action='store',
+        nargs='+',
+        required=False,
+
+        # Reuse keys from DATE_LABEL dict in library file instead of repeating here
+        choices=list(atlib.DATE_LABEL.keys())
+    )
+
+    # Process every event schedule which fires today. This allows a single cron
+    # entry to replace the separate entries for each event schedule.
+    parser.add_argument('--due_today', action='store_true', required=False)
+
+    # NOTE: Probably want to leave this as not required and fall back to checking
+    # for the config file in the same location as this script. If it is not found
+    # THEN we can throw an error.
+    parser.add_argument('--config_file', action='store', required=False)
+
+    # Deliver spooled notifications from the outbox and exit without looking
+    # for new events
+    parser.add_argument('--flush_outbox', action='store_true', required=False)
+
+    # Generate the notifications for every event schedule which fired between
+    # two dates (inclusive), labelled with the date each one fired on. This is
+    # used to catch up after the host was down when the notifications were due.
+    parser.add_argument(
+        '--from',
+        action='store',
+        dest='from_date',
+        required=False,
+        type=datetime.date.fromisoformat,
+        metavar='YYYY-MM-DD'
+    )
 
-parser = argparse.ArgumentParser(
-    description='Check for applicable events and generate notices for matches'
+    # Defaults to today when --from is used on its own
+    parser.add_argument(
+        '--to',
+        action='store',
+        dest='to_date',
+        required=False,
+        type=datetime.date.fromisoformat,
+        metavar='YYYY-MM-DD'
     )
 
-# This will need to be broken up later by the script
-parser.add_argument(
-    '--event_schedule',
-    action='store',
-    required=True,
+    # Bring the events database schema up to date by applying the files in the
+    # sql/migrations directory, then exit. The configured database account must
+    # be allowed to modify the events database (e.g. events_rw).
+    parser.add_argument('--apply_migrations', action='store_true', required=False)
 
-    # Reuse keys from DATE_LABEL dict in library file instead of repeating here
-    choices=list(atlib.DATE_LABEL.keys())
-)
+    # Run EXPLAIN on the configured queries, warn about any full table scans and
+    # exit without looking for new events
+    parser.add_argument('--check_queries', action='store_true', required=False)
 
-# NOTE: Probably want to leave this as not required and fall back to checking
-# for the config file in the same location as this script. If it is not found
-# THEN we can throw an error.
-parser.add_argument('--config_file', action='store', required=False)
+    # Profile the generation of notifications, writing a pstats file (--profile)
+    # and/or a report of the largest memory allocations (--trace_memory) next to
+    # the log file
+    parser.add_argument('--profile', action='store_true', required=False)
+    parser.add_argument('--trace_memory', action='store_true', required=False)
 
-try:
-    log.info('Parsing commandline options')
+    # Keep running and generate notifications for every event schedule due each
+    # day at the run time set in the config file, instead of being started by cron
+    parser.add_argument('--daemon', action='store_true', required=False)
+
+    # Arguments are parsed and validated before logging is set up or any config
+    # file is read, so invalid invocations fail fast. The parser reports any
+    # problems on stderr itself.
     args = parser.parse_args()
-except Exception as error:
-    log.exception("Unable to parse command-line arguments: %s", error)
-    sys.exit(1)
 
-# NOTE: The command-line options parser enforces specific values and requires
-# that at least one of those values is present.
-event_schedule = args.event_schedule
+    if args.to_date is not None and args.from_date is None:
+        parser.error("argument --to: requires --from")
 
-# TODO: Confirm 'None' is correct fallback value
-if args.config_file is not None:
-    global_config_file = args.config_file
-else:
-    # FIXME:
-    # The configuration parser will skip over requests for
-    # non-existant files, so it SHOULD be safe for now to
-    # set this location to an empty string.
-    global_config_file = ""
+    if args.event_schedule is None and not (
+            args.due_today or args.from_date or args.flush_outbox or args.daemon or
+            args.apply_migrations or args.check_queries):
+        parser.error("one of the following arguments is required: "
+            "--event_schedule, --due_today, --from, --daemon, --flush_outbox, "
+            "--apply_migrations, --check_queries")
 
+    if args.from_date is not None:
 
-#######################################################
-# CONSTANTS - Modify INI config files instead
-#######################################################
+        if args.due_today:
+            parser.error("argument --due_today: not allowed with argument --from")
 
-# Where this script is being called from. We will try to load local copies of all
-# dependencies from this location first before falling back to default
-# locations in order to support having all of the files bundled together for
-# testing and portable use.
-script_path = os.path.dirname(os.path.realpath(__file__))
-
-# The name of this script. It is used as needed by error/debug messages
-script_name = os.path.basename(sys.argv[0])
-
-# Read in configuration file. Attempt to read local copy first, then
-# fall back to using the copy specified on the command-line. We have
-# hard-coded the name of the local file, but the user is free to specify
-# a custom name/path using the command-line option.
-
-config_file = {}
-config_file['name'] = 'automated_tickets.ini'
-config_file['local'] = os.path.join(script_path, config_file['name'])
-
-# This location is (optionally) specified on the command-line. If it is not
-# specified, then an empty string is set instead. The Settings class will
-# confirm the file is actually present and complain if it is not.
-config_file['global'] = global_config_file
-
-# Prefer a local copy over a "global" one by loading it last (where the
-# second config file overrides or "shadows" settings from the first). If
-# a local copy does not exist, then the one specified on the command-line
-# will be used. If that one does not exist, then this script will throw
-# an error and quit.
-config_file_candidates = [config_file['global'], config_file['local']]
-
-# Generate configuration setting options
-log.debug(
-    "Passing in these config file locations for evalution: %s",
-    config_file_candidates)
-
-log.info('Parsing config files')
-settings = atlib.Settings(config_file_candidates)
-
-# Now that the settings object has been properly created, lets use it to
-# finish configuring console logging for the main application logger.
-console_handler.addFilter(atlib.ConsoleFilterFunc(settings=settings))
-app_logger.addHandler(console_handler)
-
-# Troubleshooting config file flag boolean conversion
-for key, value in list(settings.flags.items()):
-    log.debug("key: '%s' value: '%s' type of value: '%s'",
-        key,
-        value,
-        type(value))
-
-if settings.flags['testing_mode']:
-    log.warning("Test warning message to prove that the INI flag works")
-    log.error("Test error message to prove that the INI flag works")
-
-# Generate list of matching events from database based on requested event
-# schedule (daily, weekly, etc.)
-events = []
-
-log.info('Retrieving events')
-events = atlib.get_events(settings, event_schedule)
-
-message = {}
-
-for event in events:
-
-    # FIXME: Perform string substitution on object instantiation where all
-    # validity checks can be grouped together. This can simply be a reference
-    # to those pre-computed values.
-    # FIXME: Reintroduce support for multiple destination email addresses
-    message['subject'] = "{} ({})".format(
-        # Formatting the prefix string before then using the result in
-        # the larger format string we're building here
-        # NOTE: Explicitly lowering the case of the dictionary key values
-        # pulled from the events table entry in order to properly reference
-        # the associated value.
-        # FIXME: Add try/except blocks around expansion so that any KeyError
-        # exceptions can be caught and processing can continue.
-        event.email_subject_prefix.format(atlib.DATE_LABEL[event.event_schedule].lower()),
-        event.event_schedule.lower()
-    )
-    message['envelope'] = "From: {}\nTo: {}\nSubject: {}\n".format(
-        event.email_from_address, event.email_to_address, message['subject']
-        )
+        if args.to_date is None:
+            args.to_date = datetime.date.today()
 
-    log.debug("Email envelope details: %s", message['envelope'])
+        if args.to_date < args.from_date:
+            parser.error("argument --to: must not be earlier than --from")
 
-    # If this task has a known due date ...
-    if event.redmine_new_issue_due_date:
-        log.debug("Due date of %s is set for task: %s",
-            event.redmine_new_issue_due_date,
-            message['subject'])
+    mark_startup_step('argument_parsing')
 
-        message['footer'] = "\nProject: {}\nCategory: {}\nStatus: {}\nPriority: {}\nDue date: {}\n".format(
-            event.redmine_new_issue_project,
-            event.redmine_new_issue_category,
-            event.redmine_new_issue_status,
-            event.redmine_new_issue_priority,
-            event.redmine_new_issue_due_date
-        )
+
+    ########################################################
+    # Logging
+    ########################################################
+
+    app_name = 'automated-tickets'
+
+    # TODO: Configure formatter to log function/class info
+    syslog_formatter = logging.Formatter('%(name)s - %(levelname)s - %(funcName)s - %(message)s')
+    file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s')
+    stdout_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s')
+
+    # Grab root logger and set initial logging level
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+
+    # The SysLogHandler class, supports sending logging messages to a remote
+    # or local Unix syslog.
+    # TODO: Expose this value elsewhere; move to logging_config.json?
+    syslog_socket = '/dev/log'
+    try:
+        syslog_handler = logging.handlers.SysLogHandler(address=syslog_socket)
+    except AttributeError:
+        # We're likely running on Windows, so use the NullHandler here
+        syslog_handler = logging.NullHandler()
     else:
-        log.debug("No due date set for %s", message['envelope'])
-        message['footer'] = "\nProject: {}\nCategory: {}\nStatus: {}\nPriority: {}\n".format(
-            event.redmine_new_issue_project,
-            event.redmine_new_issue_category,
-            event.redmine_new_issue_status,
-            event.redmine_new_issue_priority
-        )
+        # Good thus far, finish configuring SysLogHandler
+        syslog_handler.ident = app_name + ": "
+        syslog_handler.setFormatter(syslog_formatter)
+        syslog_handler.setLevel(logging.INFO)
 
-    log.debug("Fetching initial wiki page contents for page %s from project %s",
-        event.redmine_wiki_page_name,
-        event.redmine_wiki_page_project_shortname)
+    console_handler = logging.StreamHandler(stream=sys.stdout)
+    console_handler.setFormatter(stdout_formatter)
+    # Apply lax logging level since we will use a filter to examine message levels
+    # and compare against allowed levels set within the main config file. This
+    # filter is added later once the settings config object has been constructed.
+    console_handler.setLevel(logging.NOTSET)
 
-    # Get the raw contents of the wiki page associated with the event
-    wiki_page_contents = atlib.get_wiki_page_contents(
-        settings,
-        event.redmine_wiki_page_name,
-        event.redmine_wiki_page_project_shortname,
-        settings.mysqldb_config['redmine_database']
-    )
+    # Until the config file has been read every record is written to the log
+    # file. The level and rotation are applied once the settings are available.
+    file_handler = logging.FileHandler(app_name + '.log', mode='a')
+    file_handler.setFormatter(file_formatter)
+    file_handler.setLevel(logging.DEBUG)
+
+    # Syslog and log file writes happen on a separate thread: records are put
+    # on a queue by the logging calls and written out by the queue listener.
+    log_queue = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    log_listener = logging.handlers.QueueListener(
+        log_queue, syslog_handler, file_handler, respect_handler_level=True)
+    log_listener.start()
+
+
+    def stop_log_listener():
+
+        """
+        Write out any queued records and stop the queue listener thread
+        """
+
+        if log_listener._thread is not None:
+            log_listener.stop()
+
+
+    def shutdown_logging():
+
+        """
+        Informs the logging system to perform an orderly shutdown by flushing
+        and closing all handlers, once all queued records have been written.
+        """
+
+        stop_log_listener()
+        logging.shutdown()
+
+
+    # Also covers the sys.exit calls made by the library module on errors
+    atexit.register(stop_log_listener)
+
+    # Create logger object that inherits from root and will be inherited by
+    # all modules used by this project
+    # Note: The console_handler is added later after the settings config object
+    # has been constructed.
+    app_logger = logging.getLogger(app_name)
+    app_logger.addHandler(queue_handler)
+    app_logger.setLevel(logging.DEBUG)
 
+    log = app_logger.getChild(__name__)
+
+    log.debug("Logging initialized for %s", __name__)
+
+    log.debug("Finished importing standard modules and our custom library modules.")
+
+    mark_startup_step('logging_setup')
+
+    # NOTE: The command-line options parser enforces specific values for any
+    # explicitly requested event schedules.
+    event_schedules = []
+
+    if args.event_schedule is not None:
+        event_schedules.extend(args.event_schedule)
+
+    if args.due_today:
+        for event_schedule in atlib.get_due_schedules(atlib.DATE):
+            if event_schedule not in event_schedules:
+                event_schedules.append(event_schedule)
+
+    # Work out which event schedules to process on which dates. Every firing in
+    # the requested date range is processed in a single batched run.
+    if args.from_date is not None:
+        event_schedule_firings = []
+        for day, day_event_schedules in atlib.get_schedule_firings(args.from_date, args.to_date):
+
+            # Optionally limit the range to explicitly requested event schedules
+            if args.event_schedule is not None:
+                day_event_schedules = [
+                    event_schedule for event_schedule in day_event_schedules
+                    if event_schedule in args.event_schedule
+                ]
+
+            if day_event_schedules:
+                event_schedule_firings.append((day, day_event_schedules))
 
-    # Optionally expand any include macro calls so that a full expanded
-    # (dependency free) page is used as the body of the message
-    if settings.flags['expand_include_macros_in_wiki_pages']:
-
-        log.debug("Enabled: Expand include macros found in wiki pages")
-        # Check wiki_page_contents for include macro calls and build a
-        # list of included pages to fetch the content from.
-        wiki_page_macro_calls = []
-        wiki_page_macro_calls = atlib.get_include_calls(
-            wiki_page_contents,
-            event.redmine_wiki_page_project_shortname
-            )
-
-        log.debug("Include calls found: %s", bool(wiki_page_macro_calls))
-
-        # TODO: used in a strictly boolean context; from PEP8:
-        # For sequences, (strings, lists, tuples), use the fact that
-        # empty sequences are false
-        while wiki_page_macro_calls:
-
-            log.debug("Wiki page include macro calls found: %s",
-                wiki_page_macro_calls)
-
-            # proceed with getting the list of included pages
-            log.debug("Fetching included wiki pages ...")
-            included_wiki_pages = []
-            included_wiki_pages = atlib.get_included_wiki_pages(
-                wiki_page_macro_calls,
-                event.redmine_wiki_page_project_shortname)
-
-            # for every included page, lets grab the contents
-            while included_wiki_pages:
-                wiki_page_to_process = included_wiki_pages.pop()
-
-
-                log.debug("Fetching wiki page contents for included page %s from project %s",
-                    wiki_page_to_process,
-                    event.redmine_wiki_page_project_shortname)
-
-                included_wiki_page_contents = atlib.get_wiki_page_contents(
-                    settings,
-                    wiki_page_to_process,
-                    event.redmine_wiki_page_project_shortname,
-                    settings.mysqldb_config['redmine_database'])
-
-                # At this point we have a page name which was included by the
-                # initial page and we also have the contents of that page
-                search_value = '{{include(%s:%s)}}' % (
-                    event.redmine_wiki_page_project_shortname,
-                    wiki_page_to_process)
-
-                log.debug("Search string for include call: %s", search_value)
-
-                wiki_page_contents = wiki_page_contents.replace(search_value, included_wiki_page_contents)
-
-            # After we have processed all initial include pages, check again to
-            # see if pulling in the content from those included pages resulted
-            # in us finding more include macro calls.
-            log.debug("Parsing wiki page contents for further include calls ...")
-            wiki_page_macro_calls = atlib.get_include_calls(
-                wiki_page_contents,
-                event.redmine_wiki_page_project_shortname
-                )
     else:
-        log.debug("Disabled: Expand include macros found in wiki pages")
-        log.debug("Redmine will substitute macros with live include page contents")
-
-    # Use wiki page contents as the message body. This is either the fully
-    # expanded content after include macro calls have been processed or the
-    # original page content if the expansion option has been disabled in the
-    # automated_tickets.ini config file.
-    message['body'] = wiki_page_contents
-
-
-    # FIXME: Revisit this?
-    log.debug("FIXME: Leaving header empty")
-    message['header'] = ""
-
-    # Note:
-    #
-    #  The spacing should be EXACTLY as shown here. Having one space
-    #  between the envelope and header content results in Redmine adding
-    #  header values (Message-Id for example) directly into the OP
-    email_message = "{}{}\n{}\n{}\n".format(
-        message['envelope'],
-        message['header'],
-        message['body'],
-        message['footer']
-    )
+        event_schedule_firings = [(atlib.DATE, event_schedules)]
+
+    log.info("Event schedules to process: %s", event_schedule_firings)
+
+    # TODO: Confirm 'None' is correct fallback value
+    if args.config_file is not None:
+        global_config_file = args.config_file
+    else:
+        # FIXME:
+        # The configuration parser will skip over requests for
+        # non-existant files, so it SHOULD be safe for now to
+        # set this location to an empty string.
+        global_config_file = ""
+
+
+    #######################################################
+    # CONSTANTS - Modify INI config files instead
+    #######################################################
+
+    # Where this script is being called from. We will try to load local copies of all
+    # dependencies from this location first before falling back to default
+    # locations in order to support having all of the files bundled together for
+    # testing and portable use.
+    script_path = os.path.dirname(os.path.realpath(__file__))
+
+    # The name of this script. It is used as needed by error/debug messages
+    script_name = os.path.basename(sys.argv[0])
+
+    # Read in configuration file. Attempt to read local copy first, then
+    # fall back to using the copy specified on the command-line. We have
+    # hard-coded the name of the local file, but the user is free to specify
+    # a custom name/path using the command-line option.
+
+    config_file = {}
+    config_file['name'] = 'automated_tickets.ini'
+    config_file['local'] = os.path.join(script_path, config_file['name'])
+
+    # This location is (optionally) specified on the command-line. If it is not
+    # specified, then an empty string is set instead. The Settings class will
+    # confirm the file is actually present and complain if it is not.
+    config_file['global'] = global_config_file
+
+    # Prefer a local copy over a "global" one by loading it last (where the
+    # second config file overrides or "shadows" settings from the first). If
+    # a local copy does not exist, then the one specified on the command-line
+    # will be used. If that one does not exist, then this script will throw
+    # an error and quit.
+    config_file_candidates = [config_file['global'], config_file['local']]
+
+    # Generate configuration setting options
+    log.debug(
+        "Passing in these config file locations for evalution: %s",
+        config_file_candidates)
+
+    # The console filter is created once and pointed at the current settings
+    # object whenever the config files are (re)loaded
+    console_filter = None
+
+
+    def configure_file_logging(settings):
+
+        """
+        Apply the level and rotation settings from the logging section of the
+        config file to the log file handler, and raise the level of the
+        application logger to the lowest level any handler will output so that
+        debug records are not even created unless something will write them.
+        """
+
+        nonlocal file_handler
+
+        file_level = logging.getLevelName(settings.logging['file_level'])
+
+        if settings.logging['max_bytes'] > 0:
+            new_file_handler = logging.handlers.RotatingFileHandler(
+                file_handler.baseFilename,
+                mode='a',
+                maxBytes=settings.logging['max_bytes'],
+                backupCount=settings.logging['backup_count'])
+        else:
+            new_file_handler = logging.FileHandler(file_handler.baseFilename, mode='a')
+
+        new_file_handler.setFormatter(file_formatter)
+        new_file_handler.setLevel(file_level)
+
+        # Swap handlers while the listener is stopped so that no queued record
+        # is written to a closed file
+        stop_log_listener()
+        file_handler.close()
+        file_handler = new_file_handler
+        log_listener.handlers = (syslog_handler, file_handler)
+        log_listener.start()
+
+        app_logger.setLevel(min(
+            file_level,
+            syslog_handler.level or logging.INFO,
+            console_filter.lowest_level()))
+
+        # Large values (e.g. rendered messages) are cut down when logged
+        atlib.LogPayload.max_chars = settings.logging['max_payload_chars']
+
+
+    def load_settings():
+
+        """
+        Parse the config files and finish configuring console logging for the
+        main application logger. Called again by the daemon on SIGHUP.
+        """
+
+        nonlocal console_filter
+
+        log.info('Parsing config files')
+        settings = atlib.Settings(config_file_candidates)
+
+        # Now that the settings object has been properly created, lets use it to
+        # finish configuring console logging for the main application logger.
+        if console_filter is None:
+            console_filter = atlib.ConsoleFilterFunc(settings=settings)
+            console_handler.addFilter(console_filter)
+            app_logger.addHandler(console_handler)
+        else:
+            console_filter.settings = settings
+
+        configure_file_logging(settings)
+
+        # Troubleshooting config file flag boolean conversion
+        for key, value in list(settings.flags.items()):
+            log.debug("key: '%s' value: '%s' type of value: '%s'",
+                key,
+                value,
+                type(value))
+
+        if settings.flags['testing_mode']:
+            log.warning("Test warning message to prove that the INI flag works")
+            log.error("Test error message to prove that the INI flag works")
+
+        return settings
+
+
+    if args.daemon:
+
+        daemon = atlib.TicketDaemon(load_settings)
+        mark_startup_step('settings_load')
+        log.info("Startup time breakdown (seconds): %s", startup_times)
+
+        daemon.run_forever()
+
+        shutdown_logging()
+        sys.exit(0)
+
+    settings = load_settings()
+
+    mark_startup_step('settings_load')
+    log.info("Startup time breakdown (seconds): %s", startup_times)
+
+    if args.flush_outbox:
+
+        if not settings.outbox['directory']:
+            log.error("Unable to flush outbox: no outbox directory is configured")
+            sys.exit(1)
+
+        outbox = atlib.Outbox(
+            settings.outbox['directory'],
+            settings.outbox['max_attempts'],
+            settings.outbox['retry_base_seconds'])
+
+        with atlib.EmailNotifier(settings) as notifier:
+            outbox.flush(notifier)
+
+        shutdown_logging()
+        sys.exit(0)
+
+    if args.apply_migrations or args.check_queries:
+
+        db_pool = atlib.ConnectionPool(settings)
+
+        if args.apply_migrations:
+            atlib.apply_migrations(
+                settings, db_pool, os.path.join(script_path, 'sql', 'migrations'))
+
+        full_scans = []
+        if args.check_queries:
+            full_scans = atlib.check_queries(settings, db_pool)
+
+        db_pool.close()
+
+        shutdown_logging()
+        sys.exit(1 if full_scans else 0)
+
+    generator = atlib.TicketGenerator(settings)
+
+    with atlib.profiling(
+            os.path.dirname(file_handler.baseFilename),
+            profile=args.profile,
+            trace_memory=args.trace_memory):
+        results = generator.run_firings(event_schedule_firings)
+
+    # Included with the run metrics so that a budget can be kept on startup time
+    for step, seconds in startup_times.items():
+        generator.metrics.add_stage('startup_' + step, seconds)
+
+    generator.log_summary(results)
+    generator.close()
+
+    # Informs the logging system to perform an orderly shutdown by flushing and
+    # closing all handlers.
+    shutdown_logging()
+
+    if any(error is not None for event, error in results):
+        sys.exit(1)
 
-    # Send notification
-    log.info('Sending email notification')
-    atlib.send_notification(settings, event.email_from_address, event.email_to_address, email_message)
 
-# Informs the logging system to perform an orderly shutdown by flushing and
-# closing all handlers.
-logging.shutdown()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,677 @@
+#!/usr/bin/env python3
+
+"""
+Purpose: Measure how automated_tickets scales. A synthetic events table and
+set of Redmine wiki tables are seeded into a local SQLite database which is
+served through an in-process stand-in for the mysql.connector module, and
+notifications are delivered to a local SMTP sink. Throughput, per-stage
+latency percentiles and peak memory are written out as JSON so that results
+can be compared across versions.
+
+Example:
+
+    ./automated_tickets_bench.py --events 500 --fan_out 3 --depth 2 \
+        --iterations 5 --output bench.json
+"""
+
+
+#######################################################
+# Module Imports
+#######################################################
+
+import argparse
+import configparser
+import functools
+import json
+import logging
+import os
+import os.path
+import platform
+import resource
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+
+app_name = 'automated-tickets'
+
+# Where this script is being called from. The library module and the main
+# config file are expected to be found alongside it.
+script_path = os.path.dirname(os.path.realpath(__file__))
+
+
+#######################################################
+# mysql.connector stand-in
+#######################################################
+
+class FakeMySQLError(Exception):
+
+    """
+    Stand-in for mysql.connector.Error
+    """
+
+
+class FakeMySQLCursor(object):
+
+    """
+    Implements the subset of the mysql.connector cursor interface used by
+    the library module on top of a SQLite cursor. The cursor options
+    (buffered, prepared, ...) are accepted and ignored. Each statement
+    waits for latency seconds first, standing in for the round trip to a
+    database server.
+    """
+
+    def __init__(self, sqlite_connection, latency):
+        self._cursor = sqlite_connection.cursor()
+        self._latency = latency
+
+    def execute(self, query, params=None):
+        if self._latency:
+            time.sleep(self._latency)
+        # MySQL parameter markers to SQLite ones
+        try:
+            self._cursor.execute(query.replace('%s', '?'), tuple(params or ()))
+        except sqlite3.Error as error:
+            raise FakeMySQLError(str(error)) from error
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+class FakeMySQLConnection(object):
+
+    """
+    Implements the subset of the mysql.connector connection interface used
+    by the library module. Every database name maps to the same SQLite file.
+    """
+
+    def __init__(self, database_file, latency, **connect_options):
+        self._db = sqlite3.connect(database_file, check_same_thread=False)
+        self._latency = latency
+        self.database = connect_options.get('database')
+        self._connected = True
+
+    def cursor(self, **cursor_options):
+        return FakeMySQLCursor(self._db, self._latency)
+
+    def is_connected(self):
+        return self._connected
+
+    def consume_results(self):
+        pass
+
+    def commit(self):
+        self._db.commit()
+
+    def get_server_info(self):
+        return '8.0.0-bench'
+
+    def close(self):
+        self._connected = False
+        self._db.close()
+
+
+def install_fake_mysql(database_file, latency=0):
+
+    """
+    Register a stand-in for the mysql.connector module which serves every
+    connection from the given SQLite database, adding latency seconds to
+    each statement. Must be called before the library module is imported.
+    """
+
+    connector = types.ModuleType('mysql.connector')
+    connector.Error = FakeMySQLError
+    connector.connect = functools.partial(FakeMySQLConnection, database_file, latency)
+
+    package = types.ModuleType('mysql')
+    package.connector = connector
+
+    sys.modules['mysql'] = package
+    sys.modules['mysql.connector'] = connector
+
+
+#######################################################
+# SMTP sink
+#######################################################
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    """
+    Speaks just enough SMTP for smtplib to deliver messages, which are
+    counted and then discarded
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+
+        self.reply('220 localhost automated-tickets benchmark sink')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode('ascii', 'replace').strip().upper()
+
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 localhost')
+
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+
+                message_size = 0
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    message_size += len(line)
+
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+
+                self.server.record_message(message_size)
+                self.reply('250 OK')
+
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+
+            else:
+                # MAIL, RCPT, RSET, NOOP, ...
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+
+    """
+    Local SMTP server listening on an ephemeral port. Each message is
+    acknowledged latency seconds after it has been received, standing in
+    for a mail relay which takes a while to accept it.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self.messages_received = 0
+        self.bytes_received = 0
+
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def record_message(self, message_size):
+        with self._lock:
+            self.messages_received += 1
+            self.bytes_received += message_size
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def address(self):
+        return "{}:{}".format(*self.server_address)
+
+
+#######################################################
+# Synthetic data
+#######################################################
+
+# SQLite equivalent of the event_table_entries query in automated_tickets.ini
+EVENT_TABLE_ENTRIES_QUERY = (
+    "SELECT id,"
+    " COALESCE(email_to_address, '${email:default_to_address}'),"
+    " COALESCE(email_from_address, '${email:default_from_address}'),"
+    " email_subject_prefix, redmine_wiki_page_name,"
+    " redmine_wiki_page_project_shortname, redmine_new_issue_project,"
+    " redmine_new_issue_category, redmine_new_issue_status,"
+    " CASE WHEN redmine_new_issue_due_after_days IS NOT NULL"
+    " THEN date('now', '+' || redmine_new_issue_due_after_days || ' days') END,"
+    " redmine_new_issue_priority, event_schedule"
+    " FROM events WHERE enabled = 1"
+)
+
+
+def filler_text(size, seed):
+
+    """
+    Return roughly size characters of wiki markup
+    """
+
+    line = "* Step {} of the checklist, see the documentation for details\n".format(seed)
+    return (line * (size // len(line) + 1))[:size]
+
+
+def seed_database(database_file, options):
+
+    """
+    Create and fill the events table and the Redmine wiki tables. Every
+    event gets its own primary wiki page; primary pages include fan_out
+    shared pages, each of which includes fan_out pages of the next level,
+    down to the requested depth.
+    """
+
+    db = sqlite3.connect(database_file)
+
+    db.executescript("""
+        CREATE TABLE events (
+            id INTEGER PRIMARY KEY, enabled INTEGER, intern_task INTEGER,
+            email_to_address TEXT, email_from_address TEXT,
+            email_subject_prefix TEXT, redmine_wiki_page_name TEXT,
+            redmine_wiki_page_project_shortname TEXT,
+            redmine_new_issue_project TEXT, redmine_new_issue_category TEXT,
+            redmine_new_issue_status TEXT,
+            redmine_new_issue_due_after_days INTEGER,
+            redmine_new_issue_priority TEXT, event_schedule TEXT);
+        CREATE INDEX events_schedule_lookup ON events (event_schedule, enabled, intern_task);
+        CREATE TABLE projects (id INTEGER PRIMARY KEY, identifier TEXT);
+        CREATE TABLE wikis (id INTEGER PRIMARY KEY, project_id INTEGER);
+        CREATE TABLE wiki_pages (id INTEGER PRIMARY KEY, wiki_id INTEGER, title TEXT COLLATE NOCASE);
+        CREATE INDEX wiki_pages_title ON wiki_pages (wiki_id, title);
+        CREATE TABLE wiki_contents (
+            id INTEGER PRIMARY KEY, page_id INTEGER, text TEXT,
+            version INTEGER, updated_on TEXT);
+        CREATE INDEX wiki_contents_page ON wiki_contents (page_id);
+    """)
+
+    wiki_pages = []
+
+    for project_number in range(options.projects):
+
+        project = "project{}".format(project_number)
+
+        db.execute("INSERT INTO projects VALUES (?, ?)", (project_number + 1, project))
+        db.execute("INSERT INTO wikis VALUES (?, ?)", (project_number + 1, project_number + 1))
+
+        # Shared included pages, one set of fan_out pages per include level
+        for level in range(1, options.depth + 1):
+            for branch in range(options.fan_out):
+
+                text = filler_text(options.page_size, "{}.{}".format(level, branch))
+
+                if level < options.depth:
+                    text += "".join(
+                        "{{{{include({}:Include {} {})}}}}\n".format(project, level + 1, child)
+                        for child in range(options.fan_out))
+
+                wiki_pages.append((project_number + 1, "Include {} {}".format(level, branch), text))
+
+    for event_number in range(options.events):
+
+        project_number = event_number % options.projects
+        project = "project{}".format(project_number)
+        wiki_page_name = "Event {}".format(event_number)
+
+        text = filler_text(options.page_size, event_number)
+        if options.depth > 0:
+            text += "".join(
+                "{{{{include({}:Include 1 {})}}}}\n".format(project, branch)
+                for branch in range(options.fan_out))
+
+        wiki_pages.append((project_number + 1, wiki_page_name, text))
+
+        db.execute(
+            "INSERT INTO events VALUES (?, 1, 0, NULL, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (event_number + 1, "Benchmark task {} {{}}".format(event_number),
+             wiki_page_name, project, "Benchmark", "Maintenance", "Assigned",
+             7 if event_number % 2 else None, "Normal", "daily"))
+
+    for page_id, (wiki_id, title, text) in enumerate(wiki_pages, start=1):
+        db.execute("INSERT INTO wiki_pages VALUES (?, ?, ?)", (page_id, wiki_id, title))
+        db.execute("INSERT INTO wiki_contents VALUES (?, ?, ?, 1, '2020-01-01 00:00:00')",
+            (page_id, page_id, text))
+
+    db.commit()
+    db.close()
+
+    return len(wiki_pages)
+
+
+def write_config_file(config_path, smtp_address, options):
+
+    """
+    Write a copy of the main config file pointed at the local stand-ins.
+    Optional features which write to local disk (outbox, ledger, persistent
+    cache) are left disabled so that only the core path is measured.
+    """
+
+    parser = configparser.RawConfigParser()
+    parser.read(os.path.join(script_path, 'automated_tickets.ini'))
+
+    parser.set('flags', 'testing_mode', 'false')
+    parser.set('flags', 'expand_include_macros_in_wiki_pages',
+        'true' if options.expand_include_macros else 'false')
+    parser.set('notification_servers', 'email_server_ip_or_fqdn', smtp_address)
+    parser.set('queries', 'event_table_entries', EVENT_TABLE_ENTRIES_QUERY)
+
+    for section, values in (
+            ('include_macros', {'max_depth': options.depth + 1}),
+            ('workers', {
+                'delivery_workers': options.delivery_workers,
+                'engine': options.engine,
+                'async_redmine_db_limit': options.redmine_db_limit,
+                'async_smtp_limit': options.smtp_limit,
+            }),
+            ('outbox', {'directory': ''}),
+            ('ledger', {'ledger_file': ''}),
+            ('wiki_cache', {'cache_file': ''})):
+
+        if not parser.has_section(section):
+            parser.add_section(section)
+
+        for key, value in values.items():
+            parser.set(section, key, str(value))
+
+    with open(config_path, 'w') as fh:
+        parser.write(fh)
+
+
+#######################################################
+# Measurements
+#######################################################
+
+class StageTimer(object):
+
+    """
+    Collects the duration of every call made to the instrumented functions,
+    grouped by stage name
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, owner, attribute, stage):
+
+        """
+        Replace owner.attribute with a version which records its duration
+        """
+
+        original = getattr(owner, attribute)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+
+        setattr(owner, attribute, timed)
+
+    def wrap_generator(self, owner, attribute, stage):
+
+        """
+        Replace the generator function owner.attribute with a version which
+        records how long each item takes to be produced. Generators only do
+        their work as they are iterated, so timing the call itself would
+        measure nothing.
+        """
+
+        original = getattr(owner, attribute)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            iterator = original(*args, **kwargs)
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.record(stage, time.perf_counter() - started)
+                yield item
+
+        setattr(owner, attribute, timed)
+
+    def summary(self):
+
+        """
+        Return count, mean and latency percentiles (in milliseconds) for
+        each stage
+        """
+
+        return {
+            stage: summarize(samples)
+            for stage, samples in sorted(self.samples.items())
+        }
+
+
+def percentile(sorted_samples, fraction):
+
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+
+    index = max(int(round(fraction * len(sorted_samples) + 0.5)) - 1, 0)
+    return sorted_samples[min(index, len(sorted_samples) - 1)]
+
+
+def summarize(samples):
+
+    sorted_samples = sorted(samples)
+
+    return {
+        'count': len(sorted_samples),
+        'total_ms': sum(sorted_samples) * 1000,
+        'mean_ms': sum(sorted_samples) / len(sorted_samples) * 1000,
+        'p50_ms': percentile(sorted_samples, 0.50) * 1000,
+        'p90_ms': percentile(sorted_samples, 0.90) * 1000,
+        'p99_ms': percentile(sorted_samples, 0.99) * 1000,
+        'max_ms': sorted_samples[-1] * 1000,
+    }
+
+
+def instrument(atlib, stage_timer):
+
+    """
+    Time the stages of a run by wrapping the library functions and methods
+    which implement them
+    """
+
+    stage_timer.wrap_generator(atlib, 'iter_events', 'events_query')
+    stage_timer.wrap(atlib.WikiPageCache, '_fetch', 'wiki_fetch')
+    stage_timer.wrap(atlib.IncludeExpander, 'load', 'include_load')
+    stage_timer.wrap(atlib.IncludeExpander, 'expand', 'include_expand')
+    stage_timer.wrap(atlib.TicketGenerator, 'render_message', 'render')
+    stage_timer.wrap(atlib.EmailNotifier, 'send', 'deliver')
+    stage_timer.wrap(atlib.TicketGenerator, 'run_firings', 'run')
+
+
+#######################################################
+# Main
+#######################################################
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark automated_tickets against local MySQL and SMTP stand-ins'
+        )
+
+    parser.add_argument('--events', type=int, default=200,
+        help='number of events to generate notifications for')
+    parser.add_argument('--projects', type=int, default=4,
+        help='number of Redmine projects the wiki pages are spread over')
+    parser.add_argument('--page_size', type=int, default=2000,
+        help='size of each wiki page in characters, before include macro calls')
+    parser.add_argument('--fan_out', type=int, default=2,
+        help='number of include macro calls per page')
+    parser.add_argument('--depth', type=int, default=2,
+        help='number of levels of included pages')
+    parser.add_argument('--delivery_workers', type=int, default=1)
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+        help='how events are processed (see the workers section of the config file)')
+    parser.add_argument('--redmine_db_limit', type=int, default=1,
+        help='Redmine database calls made at once by the asyncio engine')
+    parser.add_argument('--smtp_limit', type=int, default=1,
+        help='notifications sent at once by the asyncio engine')
+    parser.add_argument('--db_latency_ms', type=float, default=0,
+        help='delay added to every database statement')
+    parser.add_argument('--smtp_latency_ms', type=float, default=0,
+        help='delay before the SMTP sink accepts each message')
+    parser.add_argument('--no_expand', dest='expand_include_macros',
+        action='store_false', help='leave include macros for Redmine to expand')
+    parser.add_argument('--iterations', type=int, default=3,
+        help='number of complete runs to measure')
+    parser.add_argument('--trace_memory', action='store_true',
+        help='also report the peak of Python allocations (slows the run down)')
+    parser.add_argument('--output', action='store',
+        help='write the JSON results to this file instead of stdout')
+
+    options = parser.parse_args()
+
+    if options.events < 1 or options.projects < 1 or options.iterations < 1:
+        parser.error("--events, --projects and --iterations must be at least 1")
+
+    if options.fan_out < 1 and options.depth > 0:
+        parser.error("--fan_out must be at least 1 when --depth is used")
+
+    return options
+
+
+def main():
+
+    options = parse_arguments()
+
+    # Keep library logging from skewing the measurements
+    logging.getLogger(app_name).setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='automated-tickets-bench-') as work_dir:
+
+        database_file = os.path.join(work_dir, 'bench.db')
+        config_file = os.path.join(work_dir, 'automated_tickets.ini')
+
+        wiki_page_count = seed_database(database_file, options)
+
+        install_fake_mysql(database_file, options.db_latency_ms / 1000)
+
+        sys.path.insert(0, script_path)
+        import automated_tickets_lib as atlib
+
+        smtp_sink = SMTPSink(options.smtp_latency_ms / 1000)
+        smtp_sink.start()
+
+        write_config_file(config_file, smtp_sink.address, options)
+        settings = atlib.Settings([config_file])
+
+        stage_timer = StageTimer()
+        instrument(atlib, stage_timer)
+
+        if options.trace_memory:
+            tracemalloc.start()
+
+        events_processed = 0
+        failed = 0
+        run_seconds = []
+
+        for iteration in range(options.iterations):
+
+            generator = atlib.TicketGenerator(settings)
+
+            started = time.perf_counter()
+            results = generator.run(['daily'])
+            run_seconds.append(time.perf_counter() - started)
+
+            generator.close()
+
+            # Counters reported by the library for the last run
+            run_metrics = generator.metrics.as_dict()
+
+            events_processed += run_metrics['counters']['events_processed']
+            failed += sum(1 for event, error in results if error is not None)
+
+        if options.trace_memory:
+            tracemalloc_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            tracemalloc_peak = None
+
+        smtp_sink.stop()
+
+    events_expected = options.events * options.iterations
+
+    report = {
+        'benchmark': 'automated_tickets',
+        'python': platform.python_version(),
+        'parameters': {
+            'events': options.events,
+            'projects': options.projects,
+            'page_size': options.page_size,
+            'fan_out': options.fan_out,
+            'depth': options.depth,
+            'wiki_pages': wiki_page_count,
+            'delivery_workers': options.delivery_workers,
+            'engine': options.engine,
+            'redmine_db_limit': options.redmine_db_limit,
+            'smtp_limit': options.smtp_limit,
+            'db_latency_ms': options.db_latency_ms,
+            'smtp_latency_ms': options.smtp_latency_ms,
+            'expand_include_macros': options.expand_include_macros,
+            'iterations': options.iterations,
+        },
+        'events_expected': events_expected,
+        'events_processed': events_processed,
+        'events_failed': failed,
+        'messages_delivered': smtp_sink.messages_received,
+        'bytes_delivered': smtp_sink.bytes_received,
+        'throughput_events_per_second': events_processed / sum(run_seconds),
+        'run_seconds': run_seconds,
+        'stages': stage_timer.summary(),
+        'last_run_metrics': run_metrics,
+        'memory': {
+            # ru_maxrss is reported in kilobytes on Linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'tracemalloc_peak_bytes': tracemalloc_peak,
+        },
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as fh:
+            fh.write(output + '\n')
+    else:
+        print(output)
+
+    # A run which skipped or lost events would look faster than it is
+    if events_processed < events_expected or smtp_sink.messages_received < events_expected:
+        print("Expected {} events to be delivered, but {} were processed and {} delivered".format(
+            events_expected, events_processed, smtp_sink.messages_received), file=sys.stderr)
+        return 1
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
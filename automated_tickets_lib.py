@@ -13,14 +13,25 @@ Library module used by the automated_tickets.py script. Not intended for direct
 # Modules - Standard Library
 ########################################
 
+import collections
 import configparser
+import contextlib
 import datetime
+import functools
+import json
 import logging
 import logging.handlers
 import os
 import re
-import smtplib
+import signal
 import sys
+import threading
+import time
+
+# NOTE: Modules which are slow to import and only needed by some runs
+# (concurrent.futures, hashlib, smtplib, sqlite3, uuid) are imported where
+# they are used, so that --help, argument errors and runs which match no
+# events start up quickly.
 
 
 if __name__ == "__main__":
@@ -54,8 +65,10 @@ log.debug("Logging initialized for %s", __name__)
 #
 # * sudo apt-get install mysql-connector-python
 # * pip install mysql-connector-python --user
-log.debug("Attempting to import mysql.connector module")
-import mysql.connector as mysql
+#
+# The connector is comparatively slow to import, so this is deferred until
+# the first database connection is opened. See import_mysql_connector().
+mysql = None
 
 
 #######################################################
@@ -79,88 +92,286 @@ YEAR = date.strftime('%Y')
 # we will get the same result as what we're doing here
 TODAY = date.strftime('%Y-%m-%d')
 
+# strftime formats used to build the TODAY, MONTH_YEAR and YEAR labels for
+# an arbitrary date (see get_date_labels)
+TODAY_FORMAT = '%Y-%m-%d'
+MONTH_YEAR_FORMAT = '%B %Y'
+YEAR_FORMAT = '%Y'
+
+# The display format used for each event schedule keyword below
+DATE_LABEL_FORMAT = {
+    'daily':TODAY_FORMAT,
+    'twice_week':TODAY_FORMAT,
+    'weekly':TODAY_FORMAT,
+    'weekly_monday':TODAY_FORMAT,
+    'weekly_tuesday':TODAY_FORMAT,
+    'weekly_wednesday':TODAY_FORMAT,
+    'weekly_thursday':TODAY_FORMAT,
+    'weekly_friday':TODAY_FORMAT,
+    'weekly_saturday':TODAY_FORMAT,
+    'weekly_sunday':TODAY_FORMAT,
+    'twice_month':TODAY_FORMAT,
+    'monthly':MONTH_YEAR_FORMAT,
+    'twice_year':MONTH_YEAR_FORMAT,
+    'quarterly':MONTH_YEAR_FORMAT,
+    'yearly':YEAR_FORMAT,
+    'yearly_january':MONTH_YEAR_FORMAT,
+    'yearly_february':MONTH_YEAR_FORMAT,
+    'yearly_march':MONTH_YEAR_FORMAT,
+    'yearly_april':MONTH_YEAR_FORMAT,
+    'yearly_may':MONTH_YEAR_FORMAT,
+    'yearly_june':MONTH_YEAR_FORMAT,
+    'yearly_july':MONTH_YEAR_FORMAT,
+    'yearly_august':MONTH_YEAR_FORMAT,
+    'yearly_september':MONTH_YEAR_FORMAT,
+    'yearly_october':MONTH_YEAR_FORMAT,
+    'yearly_november':MONTH_YEAR_FORMAT,
+    'yearly_december':MONTH_YEAR_FORMAT,
+    'yearly_jan':MONTH_YEAR_FORMAT,
+    'yearly_feb':MONTH_YEAR_FORMAT,
+    'yearly_mar':MONTH_YEAR_FORMAT,
+    'yearly_apr':MONTH_YEAR_FORMAT,
+    'yearly_jun':MONTH_YEAR_FORMAT,
+    'yearly_jul':MONTH_YEAR_FORMAT,
+    'yearly_aug':MONTH_YEAR_FORMAT,
+    'yearly_sep':MONTH_YEAR_FORMAT,
+    'yearly_oct':MONTH_YEAR_FORMAT,
+    'yearly_nov':MONTH_YEAR_FORMAT,
+    'yearly_dec':MONTH_YEAR_FORMAT,
+}
+
 # These entries serve both as a mapping of display formats and also as
 # valid parameter values. For example, when daily events are requested,
 # active daily events will result in notifications generated which have
 # subject lines that include the value that is paired with the keyword below.
+#
+# NOTE: These labels are for the date this module was imported. Use
+# get_date_labels to build the same mapping for any other date.
 DATE_LABEL = {
-    'daily':TODAY,
-    'twice_week':TODAY,
-    'weekly':TODAY,
-    'weekly_monday':TODAY,
-    'weekly_tuesday':TODAY,
-    'weekly_wednesday':TODAY,
-    'weekly_thursday':TODAY,
-    'weekly_friday':TODAY,
-    'weekly_saturday':TODAY,
-    'weekly_sunday':TODAY,
-    'twice_month':TODAY,
-    'monthly':MONTH_YEAR,
-    'twice_year':MONTH_YEAR,
-    'quarterly':MONTH_YEAR,
-    'yearly':YEAR,
-    'yearly_january':MONTH_YEAR,
-    'yearly_february':MONTH_YEAR,
-    'yearly_march':MONTH_YEAR,
-    'yearly_april':MONTH_YEAR,
-    'yearly_may':MONTH_YEAR,
-    'yearly_june':MONTH_YEAR,
-    'yearly_july':MONTH_YEAR,
-    'yearly_august':MONTH_YEAR,
-    'yearly_september':MONTH_YEAR,
-    'yearly_october':MONTH_YEAR,
-    'yearly_november':MONTH_YEAR,
-    'yearly_december':MONTH_YEAR,
-    'yearly_jan':MONTH_YEAR,
-    'yearly_feb':MONTH_YEAR,
-    'yearly_mar':MONTH_YEAR,
-    'yearly_apr':MONTH_YEAR,
-    'yearly_may':MONTH_YEAR,
-    'yearly_jun':MONTH_YEAR,
-    'yearly_jul':MONTH_YEAR,
-    'yearly_aug':MONTH_YEAR,
-    'yearly_sep':MONTH_YEAR,
-    'yearly_oct':MONTH_YEAR,
-    'yearly_nov':MONTH_YEAR,
-    'yearly_dec':MONTH_YEAR,
+    event_schedule: DATE.strftime(date_format)
+    for event_schedule, date_format in DATE_LABEL_FORMAT.items()
+}
+
+
+def _fires_on_weekdays(*weekdays):
+    """
+    Schedule test which matches the given ISO weekdays (Monday is 1)
+    """
+    return lambda day: day.isoweekday() in weekdays
+
+
+def _fires_on_first_of(*months):
+    """
+    Schedule test which matches the first day of the given months
+    """
+    return lambda day: day.day == 1 and day.month in months
+
+
+# When each event schedule fires. This mirrors the calendar previously encoded
+# as one entry per schedule in the cron.d/automated_tickets file and is used
+# to work out every schedule which is due on a given date.
+SCHEDULE_CALENDAR = {
+    'daily': _fires_on_weekdays(1, 2, 3, 4, 5),
+    'twice_week': _fires_on_weekdays(1, 4),
+    # Historically all weekly tasks were triggered on Friday
+    'weekly': _fires_on_weekdays(5),
+    'weekly_monday': _fires_on_weekdays(1),
+    'weekly_tuesday': _fires_on_weekdays(2),
+    'weekly_wednesday': _fires_on_weekdays(3),
+    'weekly_thursday': _fires_on_weekdays(4),
+    'weekly_friday': _fires_on_weekdays(5),
+    'weekly_saturday': _fires_on_weekdays(6),
+    'weekly_sunday': _fires_on_weekdays(7),
+    'twice_month': lambda day: day.day in (1, 22),
+    'monthly': lambda day: day.day == 1,
+    'twice_year': _fires_on_first_of(1, 6),
+    'quarterly': _fires_on_first_of(3, 6, 9, 12),
+    'yearly': _fires_on_first_of(1),
+    'yearly_january': _fires_on_first_of(1),
+    'yearly_february': _fires_on_first_of(2),
+    'yearly_march': _fires_on_first_of(3),
+    'yearly_april': _fires_on_first_of(4),
+    'yearly_may': _fires_on_first_of(5),
+    'yearly_june': _fires_on_first_of(6),
+    'yearly_july': _fires_on_first_of(7),
+    'yearly_august': _fires_on_first_of(8),
+    'yearly_september': _fires_on_first_of(9),
+    'yearly_october': _fires_on_first_of(10),
+    'yearly_november': _fires_on_first_of(11),
+    'yearly_december': _fires_on_first_of(12),
+    'yearly_jan': _fires_on_first_of(1),
+    'yearly_feb': _fires_on_first_of(2),
+    'yearly_mar': _fires_on_first_of(3),
+    'yearly_apr': _fires_on_first_of(4),
+    'yearly_jun': _fires_on_first_of(6),
+    'yearly_jul': _fires_on_first_of(7),
+    'yearly_aug': _fires_on_first_of(8),
+    'yearly_sep': _fires_on_first_of(9),
+    'yearly_oct': _fires_on_first_of(10),
+    'yearly_nov': _fires_on_first_of(11),
+    'yearly_dec': _fires_on_first_of(12),
 }
 
+# Serializes writes to the testing mode notification file so that messages
+# written by several worker threads do not get interleaved
+EMAIL_DEBUG_FILE_LOCK = threading.Lock()
+
 
 
 #######################################################
 # Classes
 #######################################################
 
-class Event(object):
+# Fields of an event_reminders table entry, in the order returned by the
+# event_table_entries query, followed by the values built from them once
+# when an Event is created
+EVENT_FIELDS = (
+    'id',
+    'email_to_address',
+    'email_from_address',
+    'email_subject_prefix',
+    'redmine_wiki_page_name',
+    'redmine_wiki_page_project_shortname',
+    'redmine_new_issue_project',
+    'redmine_new_issue_category',
+    'redmine_new_issue_status',
+    'redmine_new_issue_due_date',
+    'redmine_new_issue_priority',
+    'event_schedule',
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def format_footer(project, category, status, priority, due_date):
+
+    """
+    Return the footer which sets the Redmine issue fields of a notification.
+    Events sharing the same issue fields share the same footer string.
+    """
+
+    # If this task has a known due date ...
+    if due_date:
+        return "\nProject: {}\nCategory: {}\nStatus: {}\nPriority: {}\nDue date: {}\n".format(
+            project, category, status, priority, due_date)
+
+    return "\nProject: {}\nCategory: {}\nStatus: {}\nPriority: {}\n".format(
+        project, category, status, priority)
+
+
+class Event(collections.namedtuple('Event', EVENT_FIELDS + ('subject', 'envelope', 'footer'))):
+
     """
     Represents an event from the event_reminders table
+
+    Events are immutable. The fields are stripped and checked once when the
+    event is created, at which point the subject and envelope (labelled
+    using DATE_LABEL) and the footer are built as well. Raises ValueError
+    for an entry which cannot be turned into a notification.
     """
 
-    def __init__(self, event):
+    __slots__ = ()
 
-        self.log = log.getChild(self.__class__.__name__)
+    def __new__(cls, event):
+
+        # Prune whitespace from all fields
+        fields = [field.strip() if isinstance(field, str) else field for field in event]
+
+        if len(fields) != len(EVENT_FIELDS):
+            raise ValueError("Expected {} fields, got {}".format(len(EVENT_FIELDS), len(fields)))
+
+        event = dict(zip(EVENT_FIELDS, fields))
+
+        if event['event_schedule'] not in DATE_LABEL:
+            raise ValueError("Unknown event schedule: {!r}".format(event['event_schedule']))
+
+        try:
+            subject = cls.format_subject(
+                event['email_subject_prefix'],
+                event['event_schedule'],
+                DATE_LABEL[event['event_schedule']])
+        except (IndexError, KeyError, ValueError) as error:
+            raise ValueError("Invalid email subject prefix {!r}: {}".format(
+                event['email_subject_prefix'], error)) from error
+
+        return super().__new__(
+            cls,
+            subject=subject,
+            envelope=cls.format_envelope(
+                event['email_from_address'], event['email_to_address'], subject),
+            footer=format_footer(
+                event['redmine_new_issue_project'],
+                event['redmine_new_issue_category'],
+                event['redmine_new_issue_status'],
+                event['redmine_new_issue_priority'],
+                event['redmine_new_issue_due_date']),
+            **event)
+
+    def __repr__(self):
+
+        # The precomputed strings only repeat the other fields
+        return "Event(id={!r}, event_schedule={!r}, wiki_page={!r})".format(
+            self.id,
+            self.event_schedule,
+            "{}:{}".format(self.redmine_wiki_page_project_shortname, self.redmine_wiki_page_name))
+
+    @staticmethod
+    def format_subject(email_subject_prefix, event_schedule, date_label):
+
+        """
+        Return the subject line for the given date label
+        """
+
+        # FIXME: Reintroduce support for multiple destination email addresses
+        return "{} ({})".format(
+            # Formatting the prefix string before then using the result in
+            # the larger format string we're building here
+            # NOTE: Explicitly lowering the case of the dictionary key values
+            # pulled from the events table entry in order to properly reference
+            # the associated value.
+            email_subject_prefix.format(date_label.lower()),
+            event_schedule.lower()
+        )
+
+    @staticmethod
+    def format_envelope(email_from_address, email_to_address, subject):
+
+        """
+        Return the envelope lines placed at the top of the message
+        """
+
+        return "From: {}\nTo: {}\nSubject: {}\n".format(
+            email_from_address, email_to_address, subject)
+
+    def envelope_for(self, date_labels):
+
+        """
+        Return the envelope for a notification labelled with date_labels,
+        reusing the precomputed envelope when the label matches DATE_LABEL
+        """
+
+        date_label = date_labels[self.event_schedule]
+
+        if date_label == DATE_LABEL[self.event_schedule]:
+            return self.envelope
 
-        self.log.debug("%s class, input tuple: %s", __class__, event)
+        return self.format_envelope(
+            self.email_from_address,
+            self.email_to_address,
+            self.format_subject(self.email_subject_prefix, self.event_schedule, date_label))
 
-        #log.warning("Test warning message to prove that the INI flag works")
-        #log.error("Test error message to prove that the INI flag works")
 
+class Job(collections.namedtuple('Job', ('date_labels', 'event', 'email_message'))):
 
-        # Expand out incoming tuple without hard-coding specific index values
-        (self.email_to_address,
-         self.email_from_address,
-         self.email_subject_prefix,
-         self.redmine_wiki_page_name,
-         self.redmine_wiki_page_project_shortname,
-         self.redmine_new_issue_project,
-         self.redmine_new_issue_category,
-         self.redmine_new_issue_status,
-         self.redmine_new_issue_due_date,
-         self.redmine_new_issue_priority,
-         self.event_schedule
-        ) = event
+    """
+    A notification to generate for an event, labelled using date_labels
+    (see get_date_labels). email_message is set once the notification has
+    been rendered ahead of delivery.
+    """
 
-        self.log.debug("%s: new instance of object created", __class__)
+    __slots__ = ()
+
+    def __new__(cls, date_labels, event, email_message=None):
+        return super().__new__(cls, date_labels, event, email_message)
 
 
 class Settings(object):
@@ -217,6 +428,16 @@ class Settings(object):
         # Not directly referenced yet, but exposing for future use
         self.email = {}
 
+        # Optional sections; missing sections fall back to default values
+        self.wiki_cache = {}
+        self.include_macros = {}
+        self.workers = {}
+        self.outbox = {}
+        self.daemon = {}
+        self.ledger = {}
+        self.metrics = {}
+        self.logging = {}
+
         try:
             # Grab all values from section as tuple pairs and convert
             # to dictionaries for easy reference
@@ -232,11 +453,96 @@ class Settings(object):
             # to match whatever new section name is chosen for the config file
             self.notification_servers = dict(parser.items('notification_servers'))
 
+            # Number of messages sent over one SMTP session before it is
+            # closed and a new one is opened
+            self.notification_servers['max_messages_per_session'] = \
+                parser.getint('notification_servers', 'max_messages_per_session', fallback=100)
+
             # FIXME: Is there a better to handle this?
             # This is a one-off boolean flag from a separate section
             self.mysqldb_config['raise_on_warnings'] = \
                 parser.getboolean('mysqldb_config', 'raise_on_warnings')
 
+            # Number of database connections kept open and shared by the
+            # events and Redmine databases for the length of a run. Older
+            # config files without this setting get a small default pool.
+            self.mysqldb_config['pool_size'] = \
+                parser.getint('mysqldb_config', 'pool_size', fallback=2)
+
+            # The persistent wiki page cache is disabled unless a cache file
+            # has been configured
+            self.wiki_cache = {
+                'cache_file': parser.get('wiki_cache', 'cache_file', fallback=''),
+                'max_size_mb': parser.getfloat('wiki_cache', 'max_size_mb', fallback=50),
+                'max_age_days': parser.getfloat('wiki_cache', 'max_age_days', fallback=30),
+                'max_memory_pages': max(
+                    parser.getint('wiki_cache', 'max_memory_pages', fallback=1000), 0),
+            }
+
+            self.include_macros = {
+                'max_depth': parser.getint('include_macros', 'max_depth', fallback=10),
+                'server_side_resolver':
+                    parser.getboolean('include_macros', 'server_side_resolver', fallback=False),
+            }
+
+            self.workers = {
+                'delivery_workers': parser.getint('workers', 'delivery_workers', fallback=1),
+                'chunk_size': max(parser.getint('workers', 'chunk_size', fallback=500), 1),
+                'render_workers': parser.getint('workers', 'render_workers', fallback=0),
+                'engine': parser.get('workers', 'engine', fallback='threads'),
+                'async_redmine_db_limit': max(
+                    parser.getint('workers', 'async_redmine_db_limit', fallback=1), 1),
+                'async_smtp_limit': max(
+                    parser.getint('workers', 'async_smtp_limit', fallback=1), 1),
+            }
+
+            # Notifications are sent directly unless an outbox directory
+            # has been configured
+            self.outbox = {
+                'directory': parser.get('outbox', 'directory', fallback=''),
+                'max_attempts': parser.getint('outbox', 'max_attempts', fallback=8),
+                'retry_base_seconds': parser.getfloat('outbox', 'retry_base_seconds', fallback=60),
+            }
+
+            # Only used when running as a long-lived daemon
+            self.daemon = {
+                'run_time': parser.get('daemon', 'run_time', fallback='05:45'),
+                'state_file': parser.get('daemon', 'state_file', fallback='automated_tickets.state'),
+                'max_catch_up_days': parser.getint('daemon', 'max_catch_up_days', fallback=7),
+            }
+
+            # Notifications may be generated more than once for the same
+            # period unless a ledger file has been configured
+            self.ledger = {
+                'ledger_file': parser.get('ledger', 'ledger_file', fallback=''),
+                'retention_days': parser.getfloat('ledger', 'retention_days', fallback=400),
+            }
+
+            # Run metrics are only logged unless a textfile has been
+            # configured for the node exporter to collect
+            self.metrics = {
+                'textfile': parser.get('metrics', 'textfile', fallback=''),
+            }
+
+            # Older config files without a logging section keep the original
+            # behavior: every debug record is written to a single log file
+            self.logging = {
+                'file_level': parser.get('logging', 'file_level', fallback='DEBUG').upper(),
+                'max_bytes': parser.getint('logging', 'max_bytes', fallback=0),
+                'backup_count': parser.getint('logging', 'backup_count', fallback=5),
+                'max_payload_chars': parser.getint('logging', 'max_payload_chars', fallback=500),
+            }
+
+            if not isinstance(logging.getLevelName(self.logging['file_level']), int):
+                self.log.error("Invalid file_level in logging section: %s",
+                    self.logging['file_level'])
+                sys.exit(1)
+
+            if self.workers['engine'] not in ('threads', 'asyncio'):
+                self.log.error("Invalid engine in workers section: %s",
+                    self.workers['engine'])
+                sys.exit(1)
+
             # Convert text "boolean" flag values to true boolean values
             for key in self.flags:
                 self.flags[key] = parser.getboolean('flags', key)
@@ -251,328 +557,3710 @@ class Settings(object):
             self.log.exception("Unable to parse config file: %s", error)
             sys.exit(1)
 
-class ConsoleFilterFunc(logging.Filter):
+        # Config files written for older versions may lack queries (or
+        # columns) which are needed now, so check them before they are used
+        query_problems = self.get_query_problems()
+
+        for problem in query_problems:
+            self.log.error("Invalid queries section: %s", problem)
+
+        if query_problems:
+            self.log.error("See the queries section of the bundled"
+                " automated_tickets.ini for the expected queries")
+            sys.exit(1)
+
+    def get_query_problems(self):
+
+        """
+        Return a list describing every required query which is missing from
+        the queries section or does not return the expected columns
+        """
+
+        # (query name, expected column count, expected first column, whether
+        # the query takes a {} placeholder for an IN list)
+        required_queries = [
+            ('event_table_entries', len(EVENT_FIELDS), EVENT_FIELDS[0], False),
+            ('wiki_pages_contents', 3, None, True),
+        ]
+
+        if self.wiki_cache['cache_file']:
+            required_queries.append(('wiki_pages_versions', 4, None, True))
+
+        problems = []
+
+        for query_name, column_count, first_column, in_list in required_queries:
+
+            if query_name not in self.queries:
+                problems.append("missing {} query".format(query_name))
+                continue
+
+            query = self.queries[query_name]
+
+            if in_list and '{}' not in query:
+                problems.append("{} query has no {{}} placeholder for the list of"
+                    " page titles".format(query_name))
+
+            columns = get_select_columns(query)
+
+            # Queries which cannot be parsed are left to the database
+            if columns is None:
+                continue
+
+            if first_column is not None and columns[0] != first_column:
+                problems.append("{} query must return {} as its first column,"
+                    " not {}".format(query_name, first_column, columns[0]))
+
+            if len(columns) != column_count:
+                problems.append("{} query returns {} column(s), expected {}".format(
+                    query_name, len(columns), column_count))
+
+        return problems
+
+
+class ConnectionPool(object):
 
     """
-    Honor boolean flags set within main script config file and only
-    output specific log levels to the console.
+    Pool of MySQL connections shared by the events and Redmine databases for
+    the length of a run. Connections are opened on demand (up to the
+    configured pool size), switched to the requested database on checkout
+    and handed back to the pool once the caller is finished with them, even
+    if an exception was raised while they were in use.
     """
 
     def __init__(self, settings):
+
+        self.log = log.getChild(self.__class__.__name__)
+
         self.settings = settings
-        #print("Just proving that this function is being called")
-    def filter(self, record):
-        if self.settings.flags['display_console_error_messages'] and record.levelname == 'ERROR':
-            #print("Error messages enabled")
-            return True
-        if self.settings.flags['display_console_warning_messages'] and record.levelname == 'WARNING':
-            #print("Warning messages enabled")
-            return True
-        if self.settings.flags['display_console_info_messages'] and record.levelname == 'INFO':
-            #print("Info messages enabled")
-            return True
-        if self.settings.flags['display_console_debug_messages'] and record.levelname == 'DEBUG':
-            #print("Debug messages enabled")
-            return True
-        else:
-            #print("No matches")
-            return False
+        self.pool_size = settings.mysqldb_config['pool_size']
 
-#######################################################
-# Functions
-#######################################################
+        # Idle connections, stored as (connection, database) pairs so that
+        # we know which database each connection currently has selected
+        # without having to ask the server.
+        self._idle = []
+        self._lock = threading.Lock()
 
-# TODO: Merge this function since we probably do not need a separate function
-# for this.
-def open_db_connection(settings, database):
+        # Caps the number of connections which may be checked out at once
+        self._slots = threading.BoundedSemaphore(self.pool_size)
 
-    """
-    Open a connection to the database and return a cursor object
-    """
+        # Server-side prepared statements, kept for as long as the
+        # connection they were prepared on. Maps each connection to a
+        # dictionary of {query: prepared cursor}.
+        self._prepared = {}
 
+        self.stats = {
+            'connections_opened': 0,
+            'queries_served': 0,
+            'statements_prepared': 0,
+        }
 
-    ####################################################################
-    # Open connections to databases
-    ####################################################################
+        self.log.debug("Connection pool created with a size of %s", self.pool_size)
 
-    try:
+    def _checkout(self, database):
 
-        log.debug("DB User: %s", settings.mysqldb_config["user"])
-        log.debug("DB Name: %s", database)
-        log.debug("DB Host Name/IP: %s", settings.mysqldb_config["host"])
-        log.debug("DB Host Port: %s", settings.mysqldb_config["port"])
-        log.debug("MySQL - raise_on_warnings: %s",
-            settings.mysqldb_config["raise_on_warnings"])
-        log.debug("MySQL - raise_on_warnings type: %s",
-            type(settings.mysqldb_config["raise_on_warnings"]))
+        """
+        Return an idle connection (preferring one which already has the
+        requested database selected) or open a new one.
+        """
 
-        log.info("Connecting to %s database on %s at port %s",
-            database,
-            settings.mysqldb_config["host"],
-            settings.mysqldb_config["port"])
+        mysql_connection = None
 
-        mysql_connection = mysql.connect(
-            user=settings.mysqldb_config['user'],
-            password=settings.mysqldb_config['password'],
-            host=settings.mysqldb_config['host'],
-            port=settings.mysqldb_config['port'],
-            database=database,
-            raise_on_warnings=settings.mysqldb_config['raise_on_warnings']
-        )
+        with self._lock:
+            for index, (idle_connection, idle_database) in enumerate(self._idle):
+                if idle_database == database:
+                    mysql_connection = idle_connection
+                    current_database = idle_database
+                    del self._idle[index]
+                    break
+            else:
+                if self._idle:
+                    mysql_connection, current_database = self._idle.pop()
 
-    except mysql.Error as error:
-        log.exception("Unable to connect to database: %s", error)
-        sys.exit(1)
+        if mysql_connection is not None and not mysql_connection.is_connected():
+            self.log.debug("Discarding pooled connection dropped by the server")
+            self._forget_prepared(mysql_connection)
+            mysql_connection = None
 
-    return mysql_connection
+        if mysql_connection is None:
+            mysql_connection = open_db_connection(self.settings, database)
 
+            with self._lock:
+                self.stats['connections_opened'] += 1
 
-def get_wiki_page_contents(settings, wiki_page_name, wiki_page_project, wiki_page_database):
+        elif current_database != database:
+            self.log.debug("Switching pooled connection from %s to %s database",
+                current_database, database)
+            mysql_connection.database = database
 
-    """
-    Retrieve contents of the specified Redmine wiki page for inclusion in notification
-    """
+        return mysql_connection
 
-    ####################################################################
-    # Create cursor object so that we can interact with the database
-    ####################################################################
+    @contextlib.contextmanager
+    def connection(self, database):
 
-    # TODO: Where is the cursor/connection closed/released?
-    log.info('Opening connection to database')
-    mysql_connection = open_db_connection(settings, wiki_page_database)
+        """
+        Check out a connection to the requested database for the duration
+        of the with block.
+        """
 
-    # Cursor for the MySQL copy of the database
-    mysql_cursor = mysql_connection.cursor()
+        self._slots.acquire()
+        try:
+            mysql_connection = self._checkout(database)
 
-    # Dynamically create the select query used to pull data from MySQL table
-    # See automated_tickets.ini for the available queries
-    try:
+            try:
+                yield mysql_connection
 
-        # We're filtering events on the event schedule (daily, monthly etc.)
-        # and also on whether the event is an intern task AND whether the
-        # configuration file has enabled processing those tasks.
+            except BaseException:
+                # Don't leave a half-read result set behind for the next
+                # caller to trip over.
+                try:
+                    mysql_connection.consume_results()
+                except Exception as error:
+                    self.log.debug("Closing connection in unknown state: %s", error)
+                    self._forget_prepared(mysql_connection)
+                    mysql_connection.close()
+                    raise
 
-        query = settings.queries['wiki_page_contents'].format(
-            wiki_page_name, wiki_page_project)
+                raise
 
-        log.debug("Wiki page retrieval query: %s", query)
+            finally:
+                with self._lock:
+                    self._idle.append((mysql_connection, database))
+        finally:
+            self._slots.release()
 
-        log.info('Executing query')
-        mysql_cursor.execute(query)
+    @contextlib.contextmanager
+    def cursor(self, database, **cursor_options):
 
-    except Exception as error:
-        log.exception("Unable to execute wiki page retrieval query: %s", error)
-        sys.exit(1)
+        """
+        Check out a connection and yield a cursor for it. Cursors are
+        buffered unless requested otherwise so that the connection is
+        always ready for reuse once the cursor is closed.
+        """
 
-    try:
-        # Grab first element of returned tuple, ignore everything else
-        wiki_page_content = mysql_cursor.fetchone()[0]
+        cursor_options.setdefault('buffered', True)
 
-    except Exception as error:
-        # FIXME: Is there a Plan B for wiki page lookup failures?
-        log.exception("Unable to retrieve wiki page content: %s", error)
-        sys.exit(1)
-    finally:
-        log.debug("Closing cursor ...")
-        mysql_cursor.close()
+        with self.connection(database) as mysql_connection:
+            mysql_cursor = mysql_connection.cursor(**cursor_options)
+            try:
+                yield mysql_cursor
+            finally:
+                log.debug("Closing cursor ...")
+                mysql_cursor.close()
 
-        log.debug("Closing connection ...")
-        mysql_connection.close()
+    def execute(self, mysql_cursor, query, params=None):
 
-    if wiki_page_content is not None:
+        """
+        Execute a query using a cursor obtained from this pool and count it
+        towards the per-run statistics.
+        """
 
-        # Since the fetchone call returned a list of tuples, strip out just
-        # the value and return it without the tuple or list enclosure.
-        return wiki_page_content
+        with self._lock:
+            self.stats['queries_served'] += 1
 
-    else:
+        mysql_cursor.execute(query, params)
 
-        # TODO: Is this an acceptable outcome? Should this be a hard error?
-        # The assumption here is that while one entry may be bad, we wish
-        # to continue processing the others and just note the problem.
-        error_message = "Unable to retrieve content from {}:{}".format(
-            wiki_page_project, wiki_page_name
-        )
-        log.warning(error_message)
-        return error_message
+    def _forget_prepared(self, mysql_connection):
 
-def get_include_calls(wiki_page_contents, wiki_page_project):
+        """
+        Drop the prepared statements cached for a connection which is about
+        to be (or already has been) closed
+        """
 
-    """
-    Parse the contents of the initial wiki page and pull out every instance
-    where the Redmine include macro is called. We'll use this list to
-    find included wiki pages and then later to search/replace the include
-    calls with the content of the wiki pages that the macro calls were
-    pulling into the original wiki page.
-    """
+        with self._lock:
+            prepared_cursors = self._prepared.pop(mysql_connection, {})
 
-    # This pattern is intended to match the entire include macro call,
-    # including the macro itself.
-    #
-    # NOTE: I could not get the syntax right to support using .format()
-    # so I fell back to using classic string formatting
-    # TODO: Consider moving this to external config file for easy maintenace
-    include_macro_pattern = r'{{include\(%s:[a-zA-Z0-9 _\-\']+\)}}' % (wiki_page_project)
+        for prepared_cursor in prepared_cursors.values():
+            try:
+                prepared_cursor.close()
+            except Exception as error:
+                self.log.debug("Ignoring error closing prepared statement: %s", error)
+
+    def execute_prepared(self, database, query, params):
+
+        """
+        Execute a query as a server-side prepared statement with bound
+        parameters and return all result rows. Each distinct query is
+        prepared once per connection and reused for the rest of the run.
+        """
+
+        with self.connection(database) as mysql_connection:
+
+            with self._lock:
+                prepared_cursors = self._prepared.setdefault(mysql_connection, {})
+                prepared_cursor = prepared_cursors.get(query)
+
+            if prepared_cursor is None:
+                log.debug("Preparing statement: %s", query)
 
-    # TODO: Do we properly handle zero results? Yes, the while loop which
-    # calls this function checks for an empty list to know when to stop
-    # looping.
-    wiki_page_macro_calls = []
-    wiki_page_macro_calls = re.findall(include_macro_pattern, wiki_page_contents)
+                # Prepared cursors re-use the server-side statement for as
+                # long as they keep executing the same query text
+                prepared_cursor = mysql_connection.cursor(prepared=True)
 
-    log.debug("List of include macro calls: %s", wiki_page_macro_calls)
+                with self._lock:
+                    prepared_cursors[query] = prepared_cursor
+                    self.stats['statements_prepared'] += 1
 
-    return wiki_page_macro_calls
+            self.execute(prepared_cursor, query, params)
 
+            # Prepared cursors are not buffered, so read the complete result
+            # set before the connection is handed back to the pool
+            return [decode_row(row) for row in prepared_cursor.fetchall()]
 
-def get_included_wiki_pages(wiki_page_macro_calls, wiki_page_project):
+    def close(self):
+
+        """
+        Close all idle connections. Intended to be called once at the end
+        of a run.
+        """
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        log.debug("Closing %s pooled database connection(s) ...", len(idle))
+        for mysql_connection, _ in idle:
+            self._forget_prepared(mysql_connection)
+            try:
+                mysql_connection.close()
+            except Exception as error:
+                self.log.warning("Unable to cleanly close database connection: %s", error)
+
+
+class PersistentWikiCache(object):
 
     """
-    Accepts a list of include page macro call strings and pulls out the
-    names of the pages that are being included by the primary wiki page.
-    This list of pages will be sourced and used to replace the original
-    Redmine include macro calls so that when finished, a complete page
-    (without any further include calls) is used to generate notifications.
+    On-disk (SQLite) cache of Redmine wiki page contents which outlives a
+    single run. Entries are keyed by (project, page name) and store the
+    page version and last update time reported by Redmine so that callers
+    can check whether a cached copy is still current using a cheap
+    metadata-only query.
     """
 
-    # This is meant to match just the page name that is being included
-    #
-    # NOTE: I could not get the syntax right to support using .format()
-    # so I fell back to using classic string formatting
-    # TODO: Consider moving this to external config file for easy maintenace
-    included_page_pattern = r'{{include\(%s:([a-zA-Z0-9 _\-\']+)\)}}' % (wiki_page_project)
+    def __init__(self, cache_file, max_size_mb, max_age_days):
 
-    wiki_page_names = []
+        self.log = log.getChild(self.__class__.__name__)
 
-    for match in wiki_page_macro_calls:
-        included_page = re.search(included_page_pattern, match)
+        self.cache_file = cache_file
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 60 * 60
 
-        if included_page is not None:
-            # Append the first parenthesized subgroup of the match
-            # The equivalent value appears to be 'included_page.groups()[0]'
-            wiki_page_names.append(included_page.group(1))
-        else:
-            # This function should ONLY be called if there were include
-            # macro calls in the primary wiki page. If this situation
-            # occurred then there is a bug somewhere and we need to know
-            # about it.
-            # TODO: Raise exception?
-            log.error('No matching wiki page names found')
-            sys.exit(1)
+        self.log.debug("Opening persistent wiki page cache: %s", cache_file)
+
+        self._db = open_sqlite_database(cache_file)
+        self._lock = threading.Lock()
+
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS wiki_pages ("
+                " project TEXT NOT NULL,"
+                " title TEXT NOT NULL,"
+                " version INTEGER,"
+                " updated_on TEXT,"
+                " text TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_used REAL NOT NULL,"
+                " PRIMARY KEY (project, title))"
+            )
+
+    def get_many(self, wiki_pages):
+
+        """
+        Accepts an iterable of (project, page name) pairs and returns a
+        dictionary mapping each cached pair to a (version, updated_on,
+        text) tuple.
+        """
+
+        cached_pages = {}
+
+        with self._lock:
+            for wiki_page in set(wiki_pages):
+                row = self._db.execute(
+                    "SELECT version, updated_on, text FROM wiki_pages"
+                    " WHERE project = ? AND title = ?", wiki_page).fetchone()
+
+                if row is not None:
+                    cached_pages[wiki_page] = row
+
+        return cached_pages
+
+    def touch_many(self, wiki_pages):
+
+        """
+        Record that the given cached pages were just used so that they are
+        kept over pages which have not been referenced recently.
+        """
+
+        now = time.time()
+
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE wiki_pages SET last_used = ? WHERE project = ? AND title = ?",
+                [(now,) + wiki_page for wiki_page in wiki_pages])
 
-    log.debug("List of included wiki pages: %s", wiki_page_names)
+    def put_many(self, wiki_pages):
 
-    return wiki_page_names
+        """
+        Accepts a dictionary mapping (project, page name) pairs to
+        (version, updated_on, text) tuples and stores them.
+        """
 
+        now = time.time()
 
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO wiki_pages"
+                " (project, title, version, updated_on, text, size, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (project, title, version, updated_on, text, len(text), now)
+                    for (project, title), (version, updated_on, text) in wiki_pages.items()
+                ])
 
-def get_events(settings, event_schedule):
+    def evict(self):
+
+        """
+        Drop entries which have not been used within the configured maximum
+        age, then drop the least recently used entries until the total size
+        of the cached page text fits within the configured maximum size.
+        """
+
+        with self._lock, self._db:
+
+            expired = self._db.execute(
+                "DELETE FROM wiki_pages WHERE last_used < ?",
+                (time.time() - self.max_age,)).rowcount
+
+            total_size = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM wiki_pages").fetchone()[0]
+
+            evicted = 0
+            if total_size > self.max_size:
+
+                rows = self._db.execute(
+                    "SELECT project, title, size FROM wiki_pages ORDER BY last_used").fetchall()
+
+                for project, title, size in rows:
+                    if total_size <= self.max_size:
+                        break
+                    self._db.execute(
+                        "DELETE FROM wiki_pages WHERE project = ? AND title = ?",
+                        (project, title))
+                    total_size -= size
+                    evicted += 1
+
+        self.log.debug("Persistent wiki page cache: %s expired, %s evicted to fit size limit",
+            expired, evicted)
+
+    def close(self):
+
+        """
+        Apply the eviction policy and close the cache file
+        """
+
+        self.evict()
+
+        with self._lock:
+            self._db.close()
+
+
+class SentLedger(object):
 
     """
-    Builds a list of Event objects representing rows in the event_reminders db
+    On-disk (SQLite) record of the notifications generated so far, keyed
+    by (event id, event schedule, period label). The period label is the
+    DATE_LABEL value the notification was generated for, so an event is
+    only notified once per period no matter how often a run is repeated.
     """
 
-    ####################################################################
-    # Create cursor object so that we can interact with the database
-    ####################################################################
+    def __init__(self, ledger_file, retention_days):
 
-    log.info('Opening connection to database')
-    mysql_connection = open_db_connection(settings, settings.mysqldb_config['events_database'])
+        self.log = log.getChild(self.__class__.__name__)
 
-    # Cursor for the MySQL copy of the database
-    mysql_cursor = mysql_connection.cursor()
+        self.ledger_file = ledger_file
+        self.retention = retention_days * 24 * 60 * 60
 
-    # Dynamically create the select query used to pull data from MySQL table
-    # See automated_tickets.ini for the available queries
+        self.log.debug("Opening ledger of sent notifications: %s", ledger_file)
 
+        self._db = open_sqlite_database(ledger_file)
+        self._lock = threading.Lock()
 
-    # Base query that filters just on the event schedule type. We may
-    # further constrain depending on what configuration settings have
-    # been toggled.
-    base_query = "{} AND event_schedule = '{}'".format(
-        settings.queries['event_table_entries'],
-        event_schedule)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sent_notifications ("
+                " event_id INTEGER NOT NULL,"
+                " event_schedule TEXT NOT NULL,"
+                " period_label TEXT NOT NULL,"
+                " sent_at REAL NOT NULL,"
+                " PRIMARY KEY (event_id, event_schedule, period_label))"
+            )
 
-    # Check configuration setting to determine if we need to filter out
-    # "intern" or student worker events.
-    if not settings.flags['process_intern_events']:
-        query = "{} AND event_schedule = '{}' AND intern_task = 0".format(
-            settings.queries['event_table_entries'],
-            event_schedule)
-    else:
-        # Use just the base query then
-        query = base_query
+    def get_sent(self, keys):
 
-    try:
-        log.info("Executing query")
-        mysql_cursor.execute(query)
+        """
+        Accepts an iterable of (event id, event schedule, period label)
+        tuples and returns the set of those already recorded, using a
+        single query.
+        """
 
-    except Exception as error:
-        log.exception("Unable to query event_reminders table: %s", error)
+        keys = set(keys)
+        if not keys:
+            return set()
 
-    log.debug("Pulling data from %s MySQL table ...", 'events')
+        period_labels = sorted({period_label for event_id, event_schedule, period_label in keys})
 
-    events = []
-    for event in mysql_cursor.fetchall():
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT event_id, event_schedule, period_label FROM sent_notifications"
+                " WHERE period_label IN ({})".format(', '.join('?' * len(period_labels))),
+                period_labels).fetchall()
 
-        # Prune whitespace from all fields
-        # event = tuple([item.strip() else item for item in event])
-        fields = []
-        for field in event:
-            if isinstance(field, str):
-                field = field.strip()
-            fields.append(field)
-        event = tuple(fields)
+        return keys.intersection(rows)
 
-        # Collect a list of all events we need to take action for
-        events.append(Event(event))
+    def record(self, key):
 
-    ####################################################################
-    # Cleanup
-    ####################################################################
+        """
+        Record that the notification identified by (event id, event
+        schedule, period label) has been sent
+        """
 
-    # FIXME: Can this be handled with a context manager since there are several
-    # places where an exception may occur and cause the connecton to be
-    # uncleanly closed?
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sent_notifications"
+                " (event_id, event_schedule, period_label, sent_at)"
+                " VALUES (?, ?, ?, ?)", tuple(key) + (time.time(),))
 
-    log.debug("Closing cursor ...")
-    mysql_cursor.close()
+    def close(self):
 
-    # Close database connections
-    log.debug("Closing database connection ...")
-    mysql_connection.close()
+        """
+        Drop entries older than the configured retention period and close
+        the ledger file
+        """
 
-    return events
+        with self._lock, self._db:
+            expired = self._db.execute(
+                "DELETE FROM sent_notifications WHERE sent_at < ?",
+                (time.time() - self.retention,)).rowcount
 
+        self.log.debug("Ledger of sent notifications: %s expired", expired)
+
+        with self._lock:
+            self._db.close()
+
+
+class WikiPageCache(object):
 
-# FIXME: Add the from_address and to_address values onto the message object
-def send_notification(settings, from_address, to_address, message):
     """
-    Long term, this should be an entry point to a validation and notification
-    chain of functions, supporting email, text, XMPP and other types
-    of notifications. For now, only email notifications are supported.
+    Run-scoped, in-memory cache of Redmine wiki page contents keyed by
+    (project, page name). Pages not already cached are fetched in batches,
+    so each distinct page is read from the database at most once per run
+    no matter how many events or include levels reference it.
+
+    If a PersistentWikiCache is provided, pages missing from memory are
+    first looked up there and only pages whose Redmine version has changed
+    (or which have never been cached) have their contents fetched.
+
+    Pages needed by the chunks of events being processed are pinned. Once
+    released, up to max_memory_pages of them are kept (least recently used
+    first out) so that pages shared by events in different chunks are
+    normally read only once, while the memory used stays bounded.
     """
 
-    log.debug("Notification: %s", message)
+    def __init__(self, settings, db_pool, persistent_cache=None):
 
-    email_server = settings.notification_servers['email_server_ip_or_fqdn']
-    email_debug_filename = 'email.txt'
+        self.log = log.getChild(self.__class__.__name__)
+
+        self.settings = settings
+        self.db_pool = db_pool
+        self.database = settings.mysqldb_config['redmine_database']
+        self.persistent_cache = persistent_cache
 
-    if settings.flags['testing_mode']:
+        self._pages = {}
+        self._lock = threading.Lock()
 
-        # TODO: With the automated-tickets-dev environment setting up a test
-        # mail to HTTP submission environment, should the default for test
-        # mode still be to write to a log file?
-        #
-        # Fill in details from this run at the end of the file. It is up to
-        # the caller to prune the old file if they wish to have the new
-        # results go to a clean file.
-        with open(email_debug_filename, "a") as fh:
-            fh.writelines(message)
+        # Pages which could not be found are only looked for once per run
+        self._not_found = set()
 
-    else:
+        # Number of unprocessed chunks needing each pinned page, and the
+        # released pages still held in memory, least recently used first
+        self.max_memory_pages = settings.wiki_cache['max_memory_pages']
+        self._pinned = collections.Counter()
+        self._released = collections.OrderedDict()
+
+        # Per-run counters, reported at the end of the run
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'persistent_hits': 0,
+            'pages_fetched': 0,
+            'bytes_fetched': 0,
+        }
+
+    def _count_fetched(self, fetched_wiki_pages):
+
+        with self._lock:
+            self.stats['pages_fetched'] += len(fetched_wiki_pages)
+            self.stats['bytes_fetched'] += sum(
+                len(text) for text in fetched_wiki_pages.values())
+
+    def _fetch(self, wiki_pages):
+
+        """
+        Fetch pages which are not held in memory, consulting the persistent
+        cache first if one is available.
+        """
+
+        if self.persistent_cache is None:
+            fetched_wiki_pages = get_wiki_pages_contents(
+                self.settings, wiki_pages, self.database, self.db_pool)
+
+            self._count_fetched(fetched_wiki_pages)
+
+            return fetched_wiki_pages
+
+        current_versions = get_wiki_pages_versions(
+            self.settings, wiki_pages, self.database, self.db_pool)
+
+        cached_pages = self.persistent_cache.get_many(current_versions)
+
+        wiki_pages_contents = {}
+        for wiki_page, (version, updated_on, text) in cached_pages.items():
+            if current_versions[wiki_page] == (version, updated_on):
+                wiki_pages_contents[wiki_page] = text
+
+        self.persistent_cache.touch_many(wiki_pages_contents)
+
+        with self._lock:
+            self.stats['persistent_hits'] += len(wiki_pages_contents)
+
+        stale_wiki_pages = set(wiki_pages).difference(wiki_pages_contents)
+
+        if stale_wiki_pages:
+
+            self.log.debug("Fetching wiki pages not current in persistent cache: %s",
+                sorted(stale_wiki_pages))
+
+            fetched_wiki_pages = get_wiki_pages_contents(
+                self.settings, stale_wiki_pages, self.database, self.db_pool)
+
+            self._count_fetched(fetched_wiki_pages)
+
+            # Pages which could not be found have no version and are not
+            # worth keeping around
+            self.persistent_cache.put_many({
+                wiki_page: current_versions[wiki_page] + (text,)
+                for wiki_page, text in fetched_wiki_pages.items()
+                if wiki_page in current_versions
+            })
+
+            wiki_pages_contents.update(fetched_wiki_pages)
+
+        return wiki_pages_contents
+
+    def get_many(self, wiki_pages):
+
+        """
+        Accepts an iterable of (project, page name) pairs and returns a
+        dictionary mapping each pair to the contents of that page. Pages
+        which could not be found are left out.
+        """
+
+        wiki_pages = set(wiki_pages)
+
+        with self._lock:
+            wiki_pages_contents = {
+                wiki_page: self._pages[wiki_page]
+                for wiki_page in wiki_pages if wiki_page in self._pages
+            }
+
+            missing_wiki_pages = wiki_pages.difference(wiki_pages_contents, self._not_found)
+
+            self.stats['hits'] += len(wiki_pages) - len(missing_wiki_pages)
+            self.stats['misses'] += len(missing_wiki_pages)
+
+        if missing_wiki_pages:
+
+            self.log.debug("Wiki page cache misses: %s", sorted(missing_wiki_pages))
+
+            fetched_wiki_pages = self._fetch(missing_wiki_pages)
+
+            with self._lock:
+                self._pages.update(fetched_wiki_pages)
+                self._not_found.update(missing_wiki_pages.difference(fetched_wiki_pages))
+
+            wiki_pages_contents.update(fetched_wiki_pages)
+
+        return wiki_pages_contents
+
+    def get_many_with_includes(self, wiki_pages, max_depth):
+
+        """
+        Like get_many, but pages not already held in memory are fetched
+        along with every page they include (up to max_depth levels) using
+        one recursive query per project, so that expanding them needs no
+        further queries. Requires a server supporting recursive common
+        table expressions (see supports_recursive_cte).
+        """
+
+        wiki_pages = set(wiki_pages)
+
+        with self._lock:
+            missing_wiki_pages = wiki_pages.difference(self._pages, self._not_found)
+
+        if missing_wiki_pages:
+
+            wiki_page_rows = get_wiki_pages_closure(
+                self.settings, missing_wiki_pages, max_depth, self.database, self.db_pool)
+
+            fetched_wiki_pages = {
+                wiki_page: text for wiki_page, (version, updated_on, text) in wiki_page_rows.items()
+            }
+
+            self._count_fetched(fetched_wiki_pages)
+
+            with self._lock:
+                self._pages.update(fetched_wiki_pages)
+
+            if self.persistent_cache is not None:
+                self.persistent_cache.put_many(wiki_page_rows)
+
+        # Pages which could not be found are handled as usual
+        return self.get_many(wiki_pages)
+
+    def pin(self, wiki_pages):
+
+        """
+        Keep the given (project, page name) pairs in memory, once fetched,
+        until they are released again. Pages may be pinned more than once.
+        """
+
+        with self._lock:
+            for wiki_page in set(wiki_pages):
+                self._pinned[wiki_page] += 1
+                self._released.pop(wiki_page, None)
+
+    def release(self, wiki_pages, retained_pages=()):
+
+        """
+        Undo one pin of each of the given (project, page name) pairs. Pages
+        no longer pinned are kept in memory for the rest of the run if they
+        are in retained_pages, otherwise only while they are among the
+        max_memory_pages most recently released pages. Returns the pages
+        which have been dropped from memory.
+        """
+
+        dropped_wiki_pages = set()
+
+        with self._lock:
+            for wiki_page in set(wiki_pages):
+
+                self._pinned[wiki_page] -= 1
+
+                if self._pinned[wiki_page] > 0:
+                    continue
+
+                del self._pinned[wiki_page]
+
+                if wiki_page not in retained_pages:
+                    self._released[wiki_page] = None
+
+            while len(self._released) > self.max_memory_pages:
+                wiki_page, _ = self._released.popitem(last=False)
+                self._pages.pop(wiki_page, None)
+                dropped_wiki_pages.add(wiki_page)
+
+        return dropped_wiki_pages
+
+    def get_loaded(self, wiki_page_project, wiki_page_name):
+
+        """
+        Return the contents of a single wiki page which has already been
+        fetched (see get_many), without querying the database
+        """
+
+        with self._lock:
+            try:
+                return self._pages[(wiki_page_project, wiki_page_name)]
+            except KeyError:
+                raise LookupError("Wiki page {}:{} was not found".format(
+                    wiki_page_project, wiki_page_name)) from None
+
+
+class IncludeExpander(object):
+
+    """
+    Expands Redmine include macro calls so that a wiki page and everything
+    it includes becomes a single, self-contained body of text.
+
+    Each page is parsed once into literal text and include macro calls.
+    Included pages are discovered one nesting level at a time and each
+    level is fetched as a single batch from the wiki page cache. Expanded
+    pages are memoized for the rest of the run, so a page included by many
+    events (or many times by the same event) is only expanded once.
+    """
+
+    def __init__(self, wiki_cache, max_depth):
+
+        self.log = log.getChild(self.__class__.__name__)
+
+        self.wiki_cache = wiki_cache
+        self.max_depth = max_depth
+
+        # Parsed segments and fully expanded text, both keyed by
+        # (project, page name)
+        self._segments = {}
+        self._expanded = {}
+
+        # The shallowest include depth each parsed page has been reached at.
+        # The pages it includes have been loaded down to the maximum depth
+        # from there.
+        self._depths = {}
+
+        # Pages referenced by an include macro call. These are likely to be
+        # needed again and are kept for the rest of the run.
+        self.included_pages = set()
+
+        # Counters covering the whole run, including forgotten pages
+        self._stats = {
+            'pages_parsed': 0,
+        }
+
+        # Pages expanded during the run which are not (or no longer) held
+        # in self._expanded: forgotten pages and pages expanded by a
+        # RenderPool. Each page is counted once however often it is expanded.
+        self._expanded_elsewhere = set()
+
+        self._lock = threading.Lock()
+
+    def load(self, wiki_pages, wiki_pages_contents=None):
+
+        """
+        Accepts an iterable of (project, page name) pairs and fetches and
+        parses those pages along with every page they include, up to the
+        maximum include depth. One batch is fetched per nesting level.
+
+        When the caller has already fetched the pages themselves, their
+        contents can be passed as wiki_pages_contents (as returned by
+        WikiPageCache.get_many) so that they are not fetched again.
+
+        Pages which have already been parsed are not fetched again, but if
+        they are now reached at a shallower depth than before, the pages
+        they include are loaded again from that depth, as some of them may
+        previously have been beyond the maximum depth.
+
+        The lock is only held while merging each level, so that loads
+        running in other threads do not wait for these pages to be fetched.
+        """
+
+        level = set(wiki_pages)
+        depth = 0
+
+        while level and depth <= self.max_depth:
+
+            with self._lock:
+                wiki_pages_segments = {
+                    wiki_page: self._segments[wiki_page] for wiki_page in level
+                    if wiki_page in self._segments and self._depths[wiki_page] > depth
+                }
+                missing_wiki_pages = level.difference(self._segments)
+
+            if missing_wiki_pages:
+
+                self.log.debug("Loading %s wiki page(s) at include depth %s",
+                    len(missing_wiki_pages), depth)
+
+                if depth == 0 and wiki_pages_contents is not None:
+                    level_contents = {
+                        wiki_page: wiki_pages_contents[wiki_page]
+                        for wiki_page in missing_wiki_pages
+                        if wiki_page in wiki_pages_contents
+                    }
+                else:
+                    level_contents = self.wiki_cache.get_many(missing_wiki_pages)
+
+                wiki_pages_segments.update(
+                    ((wiki_page_project, wiki_page_name),
+                        parse_wiki_page(wiki_page_contents, wiki_page_project))
+                    for (wiki_page_project, wiki_page_name), wiki_page_contents
+                    in level_contents.items())
+
+            next_level = set()
+            for (wiki_page_project, wiki_page_name), segments in wiki_pages_segments.items():
+                next_level.update(
+                    (wiki_page_project, segment[1])
+                    for segment in segments if isinstance(segment, tuple))
+
+            with self._lock:
+
+                # Another thread may have loaded some of the same pages
+                # in the meantime
+                for wiki_page, segments in wiki_pages_segments.items():
+                    if wiki_page not in self._segments:
+                        self._segments[wiki_page] = segments
+                        self._stats['pages_parsed'] += 1
+
+                    self._depths[wiki_page] = min(self._depths.get(wiki_page, depth), depth)
+
+                self.included_pages.update(next_level)
+
+            level = next_level
+            depth += 1
+
+    def expand(self, wiki_page_project, wiki_page_name):
+
+        """
+        Return the contents of the requested wiki page with all include
+        macro calls replaced by the contents of the included pages. The
+        page must have been loaded already, so that expanding it never
+        waits on the database.
+        """
+
+        if (wiki_page_project, wiki_page_name) not in self._segments:
+            raise LookupError("Wiki page {}:{} was not found".format(
+                wiki_page_project, wiki_page_name))
+
+        return expand_wiki_page(
+            wiki_page_project,
+            wiki_page_name,
+            self._segments,
+            self.max_depth,
+            self._expanded)
+
+    def get_segments(self, wiki_pages):
+
+        """
+        Return the parsed segments of the given (project, page name) pairs
+        and of every page they include, as needed by expand_wiki_page. The
+        pages must have been loaded already.
+        """
+
+        wiki_pages_segments = {}
+
+        with self._lock:
+
+            pending = [wiki_page for wiki_page in wiki_pages if wiki_page in self._segments]
+
+            while pending:
+                wiki_page = pending.pop()
+
+                if wiki_page in wiki_pages_segments:
+                    continue
+
+                segments = self._segments[wiki_page]
+                wiki_pages_segments[wiki_page] = segments
+
+                pending.extend(
+                    (wiki_page[0], segment[1]) for segment in segments
+                    if isinstance(segment, tuple) and (wiki_page[0], segment[1]) in self._segments)
+
+        return wiki_pages_segments
+
+    def count_expanded(self, wiki_pages):
+
+        """
+        Add the (project, page name) pairs expanded outside of this
+        expander (see RenderPool) to the counters
+        """
+
+        with self._lock:
+            self._expanded_elsewhere.update(wiki_pages)
+
+    def forget(self, wiki_pages):
+
+        """
+        Drop the parsed and expanded copies of the given (project, page
+        name) pairs, except for pages which are included by other pages
+        """
+
+        with self._lock:
+            for wiki_page in set(wiki_pages).difference(self.included_pages):
+                self._segments.pop(wiki_page, None)
+                self._depths.pop(wiki_page, None)
+                if self._expanded.pop(wiki_page, None) is not None:
+                    self._expanded_elsewhere.add(wiki_page)
+
+    @property
+    def stats(self):
+
+        """
+        Number of pages parsed and of distinct pages expanded so far
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pages_expanded'] = len(self._expanded_elsewhere.union(self._expanded))
+
+        return stats
+
+
+class EmailNotifier(object):
+
+    """
+    Delivers email notifications over a single SMTP session which is kept
+    open for the length of a run instead of connecting to the mail server
+    once per notification. The session is transparently re-established if
+    the server drops it and is recycled after a configurable number of
+    messages.
+
+    If testing mode is enabled, notifications are appended to a local file
+    instead of being sent.
+    """
+
+    def __init__(self, settings):
+
+        self.log = log.getChild(self.__class__.__name__)
+
+        self.email_server = settings.notification_servers['email_server_ip_or_fqdn']
+        self.max_messages_per_session = \
+            settings.notification_servers['max_messages_per_session']
+        self.testing_mode = settings.flags['testing_mode']
+        self.email_debug_filename = 'email.txt'
+
+        self._server = None
+        self._session_messages = 0
+
+        self.stats = self.empty_stats()
+
+    @staticmethod
+    def empty_stats():
+        return {
+            'messages_sent': 0,
+            'sessions_opened': 0,
+            'smtp_seconds': 0.0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self):
+
+        import smtplib
+
+        self.log.debug("Opening SMTP session to %s", self.email_server)
+
+        self._server = smtplib.SMTP(self.email_server)
+        #self._server.set_debuglevel(1)
+        self._session_messages = 0
+        self.stats['sessions_opened'] += 1
+
+    def _disconnect(self):
+
+        import smtplib
+
+        self.log.debug("Closing SMTP session to %s after %s message(s)",
+            self.email_server, self._session_messages)
+
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError) as error:
+            # The server may have already dropped the connection
+            self.log.debug("Unable to cleanly end SMTP session: %s", error)
+            self._server.close()
+
+        self._server = None
+
+    def send(self, from_address, to_address, message):
+
+        """
+        Send a single notification, reusing the current SMTP session
+        """
+
+        log.debug("Notification: %s", LogPayload(message))
+
+        if self.testing_mode:
+
+            # TODO: With the automated-tickets-dev environment setting up a test
+            # mail to HTTP submission environment, should the default for test
+            # mode still be to write to a log file?
+            #
+            # Fill in details from this run at the end of the file. It is up to
+            # the caller to prune the old file if they wish to have the new
+            # results go to a clean file.
+            with EMAIL_DEBUG_FILE_LOCK, open(self.email_debug_filename, "a") as fh:
+                fh.writelines(message)
+
+            self.stats['messages_sent'] += 1
+            return
+
+        import smtplib
+
+        started = time.perf_counter()
+
+        try:
+            if self._server is not None and \
+                    self._session_messages >= self.max_messages_per_session:
+                self._disconnect()
+
+            if self._server is None:
+                self._connect()
+
+            try:
+                self._server.sendmail(from_address, to_address, message)
+
+            except smtplib.SMTPServerDisconnected as error:
+                # The server (or something in between) closed an idle or
+                # long-lived session. Retry once over a new session.
+                self.log.info("SMTP session dropped (%s), reconnecting", error)
+                self._server.close()
+                self._connect()
+                self._server.sendmail(from_address, to_address, message)
+
+            self._session_messages += 1
+            self.stats['messages_sent'] += 1
+
+        finally:
+            self.stats['smtp_seconds'] += time.perf_counter() - started
+
+    def close(self):
+
+        """
+        End the current SMTP session, if any
+        """
+
+        if self._server is not None:
+            self._disconnect()
+
+
+class NotifierPool(object):
+
+    """
+    Hands out one EmailNotifier (and so one SMTP session) per thread so that
+    several worker threads can deliver notifications at the same time.
+    """
+
+    def __init__(self, settings):
+
+        self.settings = settings
+
+        self._local = threading.local()
+        self._notifiers = []
+        self._lock = threading.Lock()
+
+        # Counters carried over from notifiers which have been closed
+        self._closed_stats = EmailNotifier.empty_stats()
+
+    def get(self):
+
+        """
+        Return the notifier belonging to the calling thread
+        """
+
+        notifier = getattr(self._local, 'notifier', None)
+
+        if notifier is None:
+            notifier = EmailNotifier(self.settings)
+            self._local.notifier = notifier
+
+            with self._lock:
+                self._notifiers.append(notifier)
+
+        return notifier
+
+    @property
+    def stats(self):
+
+        """
+        Counters summed across the notifiers of all threads, including
+        notifiers which have already been closed
+        """
+
+        with self._lock:
+            totals = dict(self._closed_stats)
+            for notifier in self._notifiers:
+                for key, value in notifier.stats.items():
+                    totals[key] += value
+
+        return totals
+
+    def close(self):
+
+        """
+        End the SMTP sessions opened by every thread. A new notifier is
+        created for any thread which sends notifications afterwards.
+        """
+
+        with self._lock:
+            for notifier in self._notifiers:
+                notifier.close()
+                for key, value in notifier.stats.items():
+                    self._closed_stats[key] += value
+
+            self._notifiers = []
+            self._local = threading.local()
+
+
+class RenderPool(object):
+
+    """
+    Expands wiki pages and assembles notifications in a pool of worker
+    processes, so that rendering very large pages is not limited to a
+    single core. Each call to render hands the workers one batch of
+    notifications per process and returns the messages in the same order.
+
+    Records logged by the workers are passed back to this process and
+    handled by the usual loggers.
+    """
+
+    def __init__(self, workers):
+
+        import concurrent.futures
+        import multiprocessing
+
+        self.log = log.getChild(self.__class__.__name__)
+
+        self.workers = workers
+
+        # Forking this (multi-threaded) process could leave a worker holding
+        # a lock taken by another thread, and is not available everywhere.
+        # Workers are started from a fresh interpreter instead, by a fork
+        # server where one is available.
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+
+        self._log_queue = context.Queue()
+        self._log_listener = logging.handlers.QueueListener(
+            self._log_queue, ForwardingHandler())
+        self._log_listener.start()
+
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=init_render_worker,
+            initargs=(self._log_queue, logging.getLogger(app_name).getEffectiveLevel()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def render(self, batches, max_depth):
+
+        """
+        Accepts a list of (items, wiki page segments) batches, where items
+        is a list of (envelope, footer, (project, page name)) tuples, and
+        renders every batch in a worker process (see render_messages).
+        Returns the list of messages for all batches, in order, along with
+        the set of (project, page name) pairs expanded by the workers. A
+        message is replaced by the exception raised while rendering it.
+        """
+
+        messages = []
+        expanded_wiki_pages = set()
+
+        for batch_messages, batch_expanded_wiki_pages in self._executor.map(
+                render_messages,
+                [items for items, wiki_pages_segments in batches],
+                [wiki_pages_segments for items, wiki_pages_segments in batches],
+                [max_depth] * len(batches)):
+
+            messages.extend(batch_messages)
+            expanded_wiki_pages.update(batch_expanded_wiki_pages)
+
+        return messages, expanded_wiki_pages
+
+    def close(self):
+
+        """
+        Stop the worker processes, then write out any records they logged
+        """
+
+        self._executor.shutdown()
+
+        if self._log_listener._thread is not None:
+            self._log_listener.stop()
+
+
+class ForwardingHandler(logging.Handler):
+
+    """
+    Passes records received from RenderPool worker processes on to the
+    logger they were originally logged to
+    """
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+class RunMetrics(object):
+
+    """
+    Timers and counters describing a single run. Time spent in each stage
+    (events query, wiki fetches, include expansion, rendering, delivery,
+    ...) is accumulated across all calls and worker threads, along with the
+    number of calls. Counters are set once the run has finished.
+    """
+
+    # Prefix of every metric written to the node exporter textfile
+    METRIC_PREFIX = 'automated_tickets'
+
+    def __init__(self):
+
+        self.started = time.time()
+        self.run_seconds = 0.0
+
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counters = {}
+
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        """
+        Time the body of the with block as part of the named stage
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+
+            with self._lock:
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+                self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    def add_stage(self, name, seconds):
+
+        """
+        Record time spent in a stage which was measured elsewhere
+        """
+
+        with self._lock:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    def as_dict(self):
+
+        with self._lock:
+            return {
+                'run_seconds': round(self.run_seconds, 6),
+                'stages': {
+                    name: {
+                        'seconds': round(seconds, 6),
+                        'calls': self.stage_calls[name],
+                    }
+                    for name, seconds in sorted(self.stage_seconds.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def format(self):
+
+        """
+        Return the metrics as a single line of JSON, suitable for logging
+        """
+
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def write_textfile(self, path):
+
+        """
+        Write the metrics in the Prometheus text exposition format for the
+        node exporter textfile collector. The file is replaced atomically so
+        that the collector never reads a partially written file.
+        """
+
+        prefix = self.METRIC_PREFIX
+        metrics = self.as_dict()
+
+        lines = [
+            "# HELP {}_last_run_timestamp_seconds Time the last run started".format(prefix),
+            "# TYPE {}_last_run_timestamp_seconds gauge".format(prefix),
+            "{}_last_run_timestamp_seconds {:.3f}".format(prefix, self.started),
+            "# HELP {}_last_run_duration_seconds Duration of the last run".format(prefix),
+            "# TYPE {}_last_run_duration_seconds gauge".format(prefix),
+            "{}_last_run_duration_seconds {}".format(prefix, metrics['run_seconds']),
+            "# HELP {}_last_run_stage_seconds Time spent in each stage of the last run".format(prefix),
+            "# TYPE {}_last_run_stage_seconds gauge".format(prefix),
+        ]
+
+        for name, stage in metrics['stages'].items():
+            lines.append('{}_last_run_stage_seconds{{stage="{}"}} {}'.format(
+                prefix, name, stage['seconds']))
+
+        lines.extend([
+            "# HELP {}_last_run_stage_calls Number of calls made to each stage in the last run".format(prefix),
+            "# TYPE {}_last_run_stage_calls gauge".format(prefix),
+        ])
+
+        for name, stage in metrics['stages'].items():
+            lines.append('{}_last_run_stage_calls{{stage="{}"}} {}'.format(
+                prefix, name, stage['calls']))
+
+        for name, value in metrics['counters'].items():
+            lines.extend([
+                "# TYPE {}_last_run_{} gauge".format(prefix, name),
+                "{}_last_run_{} {}".format(prefix, name, value),
+            ])
+
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+
+        os.replace(tmp_path, path)
+
+
+class TicketGenerator(object):
+
+    """
+    Generates notifications for all events matching one or more event
+    schedules. The database connection pool, persistent wiki page cache,
+    outbox and notifiers are kept for the lifetime of the generator, so
+    one instance can be reused for several runs (e.g. by the daemon) with
+    warm connections. Wiki page contents held in memory only last for a
+    single run so that changes made to the wiki are picked up.
+    """
+
+    def __init__(self, settings):
+
+        self.log = log.getChild(self.__class__.__name__)
+
+        self.settings = settings
+
+        # Database connections are opened once and shared by every query
+        self.db_pool = ConnectionPool(settings)
+
+        # Optionally keep a copy of wiki pages on local disk between runs
+        if settings.wiki_cache['cache_file']:
+            self.log.info('Using persistent wiki page cache at %s',
+                settings.wiki_cache['cache_file'])
+            self.persistent_wiki_cache = PersistentWikiCache(
+                settings.wiki_cache['cache_file'],
+                settings.wiki_cache['max_size_mb'],
+                settings.wiki_cache['max_age_days'])
+        else:
+            self.persistent_wiki_cache = None
+
+        # Rendered notifications are optionally spooled to a local outbox and
+        # delivered by a separate flush step instead of being sent right away
+        if settings.outbox['directory']:
+            self.log.info('Using outbox at %s', settings.outbox['directory'])
+            self.outbox = Outbox(
+                settings.outbox['directory'],
+                settings.outbox['max_attempts'],
+                settings.outbox['retry_base_seconds'])
+        else:
+            self.outbox = None
+
+        # Each worker thread reuses a single SMTP session for every
+        # notification it sends during a run
+        self.notifiers = NotifierPool(settings)
+
+        # Optionally render notifications in worker processes
+        if settings.workers['render_workers'] > 1:
+            self.log.info('Rendering notifications using %s worker processes',
+                settings.workers['render_workers'])
+            self.render_pool = RenderPool(settings.workers['render_workers'])
+        else:
+            self.render_pool = None
+
+        # Optionally skip notifications already generated by an earlier
+        # (possibly interrupted) run for the same period
+        if settings.ledger['ledger_file']:
+            self.log.info('Using ledger of sent notifications at %s',
+                settings.ledger['ledger_file'])
+            self.ledger = SentLedger(
+                settings.ledger['ledger_file'],
+                settings.ledger['retention_days'])
+        else:
+            self.ledger = None
+
+        self.skipped_events = 0
+        self.invalid_rows = []
+
+        # Replaced at the start of every run
+        self.wiki_cache = WikiPageCache(settings, self.db_pool, self.persistent_wiki_cache)
+        self.include_expander = IncludeExpander(
+            self.wiki_cache, settings.include_macros['max_depth'])
+
+        # Replaced at the start of every run
+        self.metrics = RunMetrics()
+
+        # Whether included pages are found by the database server; checked
+        # on first use (see use_include_resolver)
+        self._include_resolver = None
+
+    def use_include_resolver(self):
+
+        """
+        Whether wiki pages should be fetched along with their included pages
+        using the server-side resolver. Only the case if it is enabled and
+        the Redmine database server supports recursive queries; otherwise
+        included pages are discovered by the client one level at a time.
+        """
+
+        if self._include_resolver is None:
+
+            self._include_resolver = False
+
+            if (self.settings.flags['expand_include_macros_in_wiki_pages']
+                    and self.settings.include_macros['server_side_resolver']):
+
+                if 'wiki_pages_closure' not in self.settings.queries:
+                    self.log.warning("Server-side include resolver enabled but no"
+                        " wiki_pages_closure query is configured; resolving includes"
+                        " client-side")
+
+                else:
+                    try:
+                        server_version = get_server_version(
+                            self.settings.mysqldb_config['redmine_database'], self.db_pool)
+                    except Exception as error:
+                        self.log.warning("Unable to determine database server version;"
+                            " resolving includes client-side: %s", error)
+                        server_version = ''
+
+                    self._include_resolver = supports_recursive_cte(server_version)
+
+                    if self._include_resolver:
+                        self.log.info("Resolving included wiki pages server-side (%s);"
+                            " this is experimental", server_version)
+                    elif server_version:
+                        self.log.warning("Database server %s does not support recursive"
+                            " queries; resolving includes client-side", server_version)
+
+        return self._include_resolver
+
+    def run(self, event_schedules, run_date=None):
+
+        """
+        Generate notifications for every event matching the given event
+        schedules. Subject lines are labelled for run_date, which defaults
+        to today. Returns a list of (event, error) pairs for the events
+        which could not be processed.
+        """
+
+        if run_date is None:
+            run_date = datetime.date.today()
+
+        return self.run_firings([(run_date, event_schedules)])
+
+    def iter_jobs(self, firings, event_schedules):
+
+        """
+        First stage of the pipeline. Retrieves the matching events one
+        chunk at a time and yields, for each chunk, a list of Job objects:
+        one for every date in firings on which the event schedule of the
+        event fires. Events already notified for the same
+        period by an earlier run are dropped using one ledger lookup per
+        chunk.
+        """
+
+        days = get_firing_days(firings)
+
+        event_chunks = iter_events(
+            self.settings, event_schedules, self.db_pool, self.settings.workers['chunk_size'],
+            self.invalid_rows)
+
+        while True:
+
+            with self.metrics.stage('events_query'):
+                events = next(event_chunks, None)
+
+            if events is None:
+                return
+
+            jobs = self.get_jobs(days, events)
+
+            if jobs:
+                yield jobs
+
+    def get_jobs(self, days, events):
+
+        """
+        Return the jobs for a chunk of events, given a list of (event
+        schedules, date labels) pairs for the dates being processed, leaving
+        out notifications recorded in the ledger
+        """
+
+        jobs = [
+            Job(date_labels, event)
+            for day_event_schedules, date_labels in days
+            for event in events
+            if event.event_schedule in day_event_schedules
+        ]
+
+        if self.ledger is not None:
+            with self.metrics.stage('ledger_lookup'):
+                sent = self.ledger.get_sent(
+                    self.ledger_key(job.event, job.date_labels) for job in jobs)
+
+            if sent:
+                self.log.info("Skipping %s notification(s) already sent", len(sent))
+
+            self.skipped_events += len(sent)
+
+            jobs = [
+                job for job in jobs
+                if self.ledger_key(job.event, job.date_labels) not in sent
+            ]
+
+        return jobs
+
+    def iter_loaded_jobs(self, job_chunks):
+
+        """
+        Second stage of the pipeline. Fetches the primary wiki page of every
+        event in a chunk using one query per project, along with the pages
+        they include (one batch per include level), before passing the
+        chunk on. Once the chunk has been processed, the primary pages are
+        released to the bounded set of recently used pages kept by the wiki
+        page cache; included pages are kept for the rest of the run.
+        """
+
+        for jobs in job_chunks:
+
+            primary_wiki_pages = self.load_jobs(jobs)
+
+            yield jobs
+
+            self.unload_jobs(primary_wiki_pages)
+
+    def load_jobs(self, jobs):
+
+        """
+        Fetch the wiki pages needed by a chunk of jobs, including the pages
+        they include when include macros are expanded. Returns the primary
+        wiki pages of the jobs, which are pinned in memory until they are
+        passed to unload_jobs once the chunk has been processed.
+        """
+
+        primary_wiki_pages = {
+            (job.event.redmine_wiki_page_project_shortname, job.event.redmine_wiki_page_name)
+            for job in jobs
+        }
+
+        # Pinned before fetching so that releasing the pages of another
+        # chunk in the meantime cannot drop them again
+        self.wiki_cache.pin(primary_wiki_pages)
+
+        log.info('Retrieving wiki pages for %s event(s)', len(jobs))
+        with self.metrics.stage('wiki_fetch'):
+            primary_wiki_pages_contents = None
+
+            # Fetch the included pages in the same query where possible, so
+            # that loading the includes below is served from memory
+            if self.use_include_resolver():
+                try:
+                    primary_wiki_pages_contents = self.wiki_cache.get_many_with_includes(
+                        primary_wiki_pages, self.settings.include_macros['max_depth'])
+
+                except Exception as error:
+                    self.log.warning("Server-side include resolver failed, resolving"
+                        " includes client-side from now on: %s", error)
+                    self._include_resolver = False
+
+            if primary_wiki_pages_contents is None:
+                primary_wiki_pages_contents = self.wiki_cache.get_many(primary_wiki_pages)
+
+        if self.settings.flags['expand_include_macros_in_wiki_pages']:
+            with self.metrics.stage('include_load'):
+                self.include_expander.load(primary_wiki_pages, primary_wiki_pages_contents)
+
+        return primary_wiki_pages
+
+    def unload_jobs(self, primary_wiki_pages):
+
+        """
+        Release the primary wiki pages of a processed chunk. Pages which are
+        included by other pages are kept for the rest of the run; parsed
+        copies of pages dropped by the wiki page cache are forgotten too.
+        """
+
+        dropped_wiki_pages = self.wiki_cache.release(
+            primary_wiki_pages, self.include_expander.included_pages)
+
+        self.include_expander.forget(dropped_wiki_pages)
+
+    def render_jobs(self, jobs):
+
+        """
+        Render a whole chunk of jobs in the render pool, if there is one.
+        Otherwise the jobs are returned as they are and each one is rendered
+        just before it is delivered.
+        """
+
+        if self.render_pool is None:
+            return jobs
+
+        with self.metrics.stage('render'):
+            email_messages = self.render_in_pool(jobs)
+
+        return [
+            job._replace(email_message=email_message)
+            for job, email_message in zip(jobs, email_messages)
+        ]
+
+    def run_firings(self, firings):
+
+        """
+        Generate notifications for a list of (date, event schedules) pairs
+        such as the one returned by get_schedule_firings. Each message is
+        labelled with the date the event schedule fired on.
+
+        Events are streamed through the pipeline a chunk at a time (fetch,
+        then wiki fetch and include load, then render, expand and deliver),
+        so memory use depends on the chunk size rather than on the number of
+        matching events. Returns a list of (event, error) pairs for the
+        events which could not be processed.
+        """
+
+        started = time.perf_counter()
+
+        # The connection pool and notifiers outlive a single run, so their
+        # counters are reported relative to the start of this run
+        self.metrics = RunMetrics()
+        db_stats_before = dict(self.db_pool.stats)
+        notifier_stats_before = self.notifiers.stats
+
+        # Wiki pages are read at most once per run, no matter how many events
+        # or include levels reference them
+        self.wiki_cache = WikiPageCache(
+            self.settings, self.db_pool, self.persistent_wiki_cache)
+        self.include_expander = IncludeExpander(
+            self.wiki_cache, self.settings.include_macros['max_depth'])
+        self.skipped_events = 0
+        self.invalid_rows = []
+
+        event_schedules = []
+        for run_date, day_event_schedules in firings:
+            for event_schedule in day_event_schedules:
+                if event_schedule not in event_schedules:
+                    event_schedules.append(event_schedule)
+
+        processed_events = 0
+        failed_events = []
+
+        log.info('Retrieving events')
+
+        if self.settings.workers['engine'] == 'asyncio':
+
+            engine = AsyncTicketEngine(
+                self,
+                self.settings.workers['async_redmine_db_limit'],
+                self.settings.workers['async_smtp_limit'])
+
+            processed_events, failed_events = engine.run(firings, event_schedules)
+
+        else:
+
+            # Events are processed one at a time unless more than one
+            # delivery worker has been configured. The same worker threads
+            # (and so the same per thread SMTP sessions) are used for every
+            # chunk of the run.
+            delivery_workers = self.settings.workers['delivery_workers']
+            executor = None
+
+            if delivery_workers > 1:
+                import concurrent.futures
+
+                self.log.info("Processing events using %s worker threads", delivery_workers)
+
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=delivery_workers, thread_name_prefix='delivery')
+
+            try:
+                for jobs in self.iter_loaded_jobs(self.iter_jobs(firings, event_schedules)):
+
+                    self.log.info("Generating notifications for %s event(s)", len(jobs))
+
+                    # A failure while processing one event is logged and does
+                    # not prevent the remaining events from being processed
+                    results = process_events(self.render_jobs(jobs), self.process_event, executor)
+
+                    processed_events += len(results)
+                    failed_events.extend(
+                        (job.event, error) for job, error in results if error is not None)
+
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+
+        # Rows which could not be turned into events count as failed events so
+        # that they are reported and the run exits with an error
+        processed_events += len(self.invalid_rows)
+        failed_events.extend(self.invalid_rows)
+
+        # Deliver everything spooled by this run (along with any earlier
+        # messages which are due for another attempt) over a single SMTP session
+        if self.outbox is not None:
+            with self.metrics.stage('outbox_flush'):
+                self.outbox.flush(self.notifiers.get())
+
+        self.notifiers.close()
+
+        if self.persistent_wiki_cache is not None:
+            self.persistent_wiki_cache.evict()
+
+        self.metrics.run_seconds = time.perf_counter() - started
+
+        db_stats = self.db_pool.stats
+        notifier_stats = self.notifiers.stats
+        wiki_cache_stats = self.wiki_cache.stats
+        include_stats = self.include_expander.stats
+
+        self.metrics.counters.update({
+            'events_processed': processed_events,
+            'events_failed': len(failed_events),
+            'events_skipped': self.skipped_events,
+            'db_connections_opened':
+                db_stats['connections_opened'] - db_stats_before['connections_opened'],
+            'db_queries':
+                db_stats['queries_served'] - db_stats_before['queries_served'],
+            'db_statements_prepared':
+                db_stats['statements_prepared'] - db_stats_before['statements_prepared'],
+            'wiki_cache_hits': wiki_cache_stats['hits'],
+            'wiki_pages_fetched': wiki_cache_stats['pages_fetched'],
+            'wiki_bytes_fetched': wiki_cache_stats['bytes_fetched'],
+            'include_pages_expanded': include_stats['pages_expanded'],
+            'smtp_sessions_opened':
+                notifier_stats['sessions_opened'] - notifier_stats_before['sessions_opened'],
+            'smtp_messages_sent':
+                notifier_stats['messages_sent'] - notifier_stats_before['messages_sent'],
+            'smtp_seconds': round(
+                notifier_stats['smtp_seconds'] - notifier_stats_before['smtp_seconds'], 6),
+        })
+
+        return failed_events
+
+    @staticmethod
+    def ledger_key(event, date_labels):
+
+        """
+        Return the key identifying the notification for an event within the
+        period it is generated for
+        """
+
+        return (event.id, event.event_schedule, date_labels[event.event_schedule])
+
+    def render_message(self, event, date_labels):
+
+        """
+        Build the complete email message for a single event
+        """
+
+        message = {}
+
+        # The subject, envelope and footer are built once when the event is
+        # created; only notifications for another date need a new envelope
+        message['envelope'] = event.envelope_for(date_labels)
+        message['footer'] = event.footer
+
+        log.debug("Email envelope details: %s", message['envelope'])
+
+        # Optionally expand any include macro calls so that a full expanded
+        # (dependency free) page is used as the body of the message
+        if self.settings.flags['expand_include_macros_in_wiki_pages']:
+
+            log.debug("Enabled: Expand include macros found in wiki pages")
+
+            # Included pages were fetched along with the chunk (one batch per
+            # include level) and are parsed and expanded once per run, then
+            # reused for every event
+            wiki_page_contents = self.include_expander.expand(
+                event.redmine_wiki_page_project_shortname,
+                event.redmine_wiki_page_name)
+
+        else:
+            log.debug("Disabled: Expand include macros found in wiki pages")
+            log.debug("Redmine will substitute macros with live include page contents")
+
+            # Get the raw contents of the wiki page associated with the event
+            wiki_page_contents = self.wiki_cache.get_loaded(
+                event.redmine_wiki_page_project_shortname,
+                event.redmine_wiki_page_name)
+
+        # Use wiki page contents as the message body. This is either the fully
+        # expanded content after include macro calls have been processed or the
+        # original page content if the expansion option has been disabled in the
+        # automated_tickets.ini config file.
+        message['body'] = wiki_page_contents
+
+
+        # FIXME: Revisit this?
+        log.debug("FIXME: Leaving header empty")
+        message['header'] = ""
+
+        return format_message(
+            message['envelope'], message['header'], message['body'], message['footer'])
+
+    def render_in_pool(self, jobs):
+
+        """
+        Render the notifications for a list of Job objects using the
+        render pool. The jobs are split into one batch per worker
+        process; each batch carries the parsed segments of only the pages
+        it needs. Returns the messages in the same order as the jobs.
+        """
+
+        expand_include_macros = self.settings.flags['expand_include_macros_in_wiki_pages']
+
+        batch_size = -(-len(jobs) // self.render_pool.workers)
+        batches = []
+
+        for start in range(0, len(jobs), batch_size):
+
+            items = [
+                (
+                    event.envelope_for(date_labels),
+                    event.footer,
+                    (event.redmine_wiki_page_project_shortname, event.redmine_wiki_page_name),
+                )
+                for date_labels, event, email_message in jobs[start:start + batch_size]
+            ]
+
+            wiki_pages = {wiki_page for envelope, footer, wiki_page in items}
+
+            if expand_include_macros:
+                wiki_pages_segments = self.include_expander.get_segments(wiki_pages)
+            else:
+                # Pages without any include calls are used as they are. Pages
+                # which were not found are reported for each event by the
+                # workers.
+                wiki_pages_segments = {}
+                for wiki_page in wiki_pages:
+                    try:
+                        wiki_pages_segments[wiki_page] = [self.wiki_cache.get_loaded(*wiki_page)]
+                    except LookupError:
+                        pass
+
+            batches.append((items, wiki_pages_segments))
+
+        messages, expanded_wiki_pages = self.render_pool.render(
+            batches, self.settings.include_macros['max_depth'])
+
+        if expand_include_macros:
+            self.include_expander.count_expanded(expanded_wiki_pages)
+
+        return messages
+
+    def process_event(self, event, date_labels, email_message=None):
+
+        """
+        Render the notification for a single event, unless it has already
+        been rendered, and send (or spool) it
+        """
+
+        # Raise errors from the render pool here so that they are reported
+        # for the event which caused them
+        if isinstance(email_message, Exception):
+            raise email_message
+
+        if email_message is None:
+            with self.metrics.stage('render'):
+                email_message = self.render_message(event, date_labels)
+
+        with self.metrics.stage('deliver'):
+            if self.outbox is not None:
+                log.info('Spooling email notification')
+                self.outbox.put(event.email_from_address, event.email_to_address, email_message)
+            else:
+                # Send notification
+                log.info('Sending email notification')
+                self.notifiers.get().send(
+                    event.email_from_address, event.email_to_address, email_message)
+
+        # Spooled messages count as sent since the outbox takes care of
+        # delivering them
+        if self.ledger is not None:
+            self.ledger.record(self.ledger_key(event, date_labels))
+
+    def log_summary(self, results):
+
+        """
+        Log the outcome of a run along with connection, cache and SMTP
+        statistics, followed by the run metrics as a single structured line.
+        The metrics are also written to the node exporter textfile if one
+        has been configured.
+        """
+
+        failed_events = [(event, error) for event, error in results if error is not None]
+
+        self.log.info("Events processed: %s, succeeded: %s, failed: %s",
+            self.metrics.counters['events_processed'],
+            self.metrics.counters['events_processed'] - len(failed_events),
+            len(failed_events))
+
+        for event, error in failed_events:
+            if isinstance(event, Event):
+                self.log.error("Failed to process event for wiki page %s:%s: %s",
+                    event.redmine_wiki_page_project_shortname,
+                    event.redmine_wiki_page_name,
+                    error)
+            else:
+                self.log.error("Failed to read event %s: %s", LogPayload(event), error)
+
+        if self.ledger is not None:
+            self.log.info("Events skipped as already sent: %s", self.skipped_events)
+
+        self.log.info("Database connections opened: %s, queries served: %s, statements prepared: %s",
+            self.db_pool.stats['connections_opened'],
+            self.db_pool.stats['queries_served'],
+            self.db_pool.stats['statements_prepared'])
+
+        self.log.info("Wiki page cache hits: %s, misses: %s, persistent cache hits: %s",
+            self.wiki_cache.stats['hits'],
+            self.wiki_cache.stats['misses'],
+            self.wiki_cache.stats['persistent_hits'])
+
+        notifier_stats = self.notifiers.stats
+
+        self.log.info("Notifications sent: %s over %s SMTP session(s)",
+            notifier_stats['messages_sent'],
+            notifier_stats['sessions_opened'])
+
+        self.log.info("Time spent in SMTP: %.3f seconds of %.3f seconds total run time",
+            notifier_stats['smtp_seconds'],
+            self.metrics.run_seconds)
+
+        self.log.info("Run metrics: %s", self.metrics.format())
+
+        if self.settings.metrics['textfile']:
+            try:
+                self.metrics.write_textfile(self.settings.metrics['textfile'])
+            except OSError as error:
+                self.log.warning("Unable to write metrics textfile %s: %s",
+                    self.settings.metrics['textfile'], error)
+
+    def close(self):
+
+        """
+        Release database connections, SMTP sessions, render worker
+        processes, the persistent cache and the ledger
+        """
+
+        self.notifiers.close()
+        self.db_pool.close()
+
+        if self.render_pool is not None:
+            self.render_pool.close()
+
+        if self.persistent_wiki_cache is not None:
+            self.persistent_wiki_cache.close()
+
+        if self.ledger is not None:
+            self.ledger.close()
+
+
+class AsyncTicketEngine(object):
+
+    """
+    Alternative to the thread based pipeline of TicketGenerator.run_firings
+    which runs on an asyncio event loop. Within a chunk of events, the jobs
+    of each project are rendered and delivered as soon as the wiki pages of
+    that project have been loaded, while the pages of other projects are
+    still being fetched. The next chunk is retrieved and started on while
+    the current one is being delivered, so database lookups overlap with
+    SMTP delivery both within and across chunks.
+
+    The database and SMTP code is blocking, so it runs in executors owned
+    by the engine, one per resource and sized to its limit:
+
+    * Events are read by a single thread, one chunk after another, since
+      the query for a chunk starts after the last event of the one before.
+      Ledger lookups for the chunk run in the same thread.
+    * The wiki pages of a chunk are fetched one project at a time, with at
+      most redmine_db_limit projects being fetched at once
+    * At most smtp_limit notifications are rendered and sent at once. Each
+      delivery thread keeps its own SMTP session, so no more sessions than
+      that are opened.
+
+    Rendering only uses wiki pages which were loaded (and pinned) before
+    the jobs of a project were handed over for delivery, so it never waits
+    on the database.
+
+    fetch_events, load_wiki_pages and deliver_job are the only places the
+    engine waits on those resources; they can be replaced with coroutine
+    functions (for example local async fakes) when exercising the engine
+    on its own. The limits apply to the replacements as well.
+    """
+
+    def __init__(self, generator, redmine_db_limit=1, smtp_limit=1):
+
+        self.log = log.getChild(self.__class__.__name__)
+
+        self.generator = generator
+
+        self.redmine_db_limit = redmine_db_limit
+        self.smtp_limit = smtp_limit
+
+    def run(self, firings, event_schedules):
+
+        """
+        Process every event matching event_schedules for the dates in
+        firings (see TicketGenerator.run_firings). Returns the number of
+        events processed and a list of (event, error) pairs for the events
+        which could not be processed.
+        """
+
+        import asyncio
+
+        return asyncio.run(self.run_async(firings, event_schedules))
+
+    async def run_async(self, firings, event_schedules):
+
+        import asyncio
+        import concurrent.futures
+
+        self.log.info("Processing events using asyncio (limits: Redmine database %s, SMTP %s)",
+            self.redmine_db_limit, self.smtp_limit)
+
+        # Created here so that they belong to the running event loop
+        self._redmine_db = asyncio.Semaphore(self.redmine_db_limit)
+        self._smtp = asyncio.Semaphore(self.smtp_limit)
+
+        self._events_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='events-db')
+        self._redmine_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.redmine_db_limit, thread_name_prefix='redmine-db')
+        self._smtp_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.smtp_limit, thread_name_prefix='delivery')
+
+        generator = self.generator
+
+        days = get_firing_days(firings)
+
+        self._event_chunks = iter_events(
+            generator.settings, event_schedules, generator.db_pool,
+            generator.settings.workers['chunk_size'], generator.invalid_rows)
+
+        processed_events = 0
+        failed_events = []
+
+        # Chunks being processed, oldest first. At most two chunks are held
+        # at once: the next chunk is only retrieved once the older of the
+        # two has been delivered.
+        processing = []
+
+        try:
+            while True:
+
+                with generator.metrics.stage('events_query'):
+                    events = await self.fetch_events()
+
+                if events is None:
+                    break
+
+                jobs = await asyncio.get_running_loop().run_in_executor(
+                    self._events_executor, generator.get_jobs, days, events)
+
+                if not jobs:
+                    continue
+
+                self.log.info("Generating notifications for %s event(s)", len(jobs))
+
+                processing.append(asyncio.ensure_future(self.process_jobs(jobs)))
+
+                if len(processing) > 1:
+                    processed_events += await self.finish_jobs(processing.pop(0), failed_events)
+
+            while processing:
+                processed_events += await self.finish_jobs(processing.pop(0), failed_events)
+
+        finally:
+            # Let deliveries already handed to a thread finish before
+            # giving up (e.g. on SystemExit from a failed query)
+            if processing:
+                await asyncio.gather(*processing, return_exceptions=True)
+
+            for executor in (self._events_executor, self._redmine_executor, self._smtp_executor):
+                executor.shutdown()
+
+        return processed_events, failed_events
+
+    async def finish_jobs(self, processing, failed_events):
+
+        """
+        Wait for a chunk started by process_jobs, add the events which could
+        not be processed to failed_events and release the wiki pages of the
+        chunk. Returns the number of events processed.
+        """
+
+        primary_wiki_pages, results = await processing
+
+        failed_events.extend(
+            (job.event, error) for job, error in results if error is not None)
+
+        self.generator.unload_jobs(primary_wiki_pages)
+
+        return len(results)
+
+    async def fetch_events(self):
+
+        """
+        Retrieve the next chunk of events, or None once all chunks have
+        been retrieved
+        """
+
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._events_executor, next, self._event_chunks, None)
+
+    async def process_jobs(self, jobs):
+
+        """
+        Load, render and deliver a chunk of jobs, one project at a time with
+        up to redmine_db_limit projects being loaded at once. Returns the
+        primary wiki pages of the jobs, to be passed to
+        TicketGenerator.unload_jobs, and a list of (job, error) pairs in the
+        same order as the jobs.
+        """
+
+        import asyncio
+
+        project_positions = {}
+        for position, job in enumerate(jobs):
+            project_positions.setdefault(
+                job.event.redmine_wiki_page_project_shortname, []).append(position)
+
+        project_results = await asyncio.gather(*(
+            self._process_project_jobs([jobs[position] for position in positions])
+            for positions in project_positions.values()))
+
+        primary_wiki_pages = set()
+        results = [None] * len(jobs)
+
+        for positions, (project_wiki_pages, project_job_results) in zip(
+                project_positions.values(), project_results):
+            primary_wiki_pages.update(project_wiki_pages)
+            for position, result in zip(positions, project_job_results):
+                results[position] = result
+
+        return primary_wiki_pages, results
+
+    async def _process_project_jobs(self, jobs):
+
+        import asyncio
+
+        async with self._redmine_db:
+            primary_wiki_pages = await self.load_wiki_pages(jobs)
+
+        if self.generator.render_pool is not None:
+            jobs = await asyncio.to_thread(self.generator.render_jobs, jobs)
+
+        errors = await asyncio.gather(*(self._deliver_job(job) for job in jobs))
+
+        return primary_wiki_pages, list(zip(jobs, errors))
+
+    async def load_wiki_pages(self, jobs):
+
+        """
+        Fetch the wiki pages of jobs for a single project (see
+        TicketGenerator.load_jobs). Returns their primary wiki pages.
+        """
+
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._redmine_executor, self.generator.load_jobs, jobs)
+
+    async def deliver_job(self, job):
+
+        """
+        Render (unless already rendered) and send a single notification.
+        Returns the exception raised while doing so, if any.
+        """
+
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._smtp_executor, process_event_safely, self.generator.process_event,
+            job.event, job.date_labels, job.email_message)
+
+    async def _deliver_job(self, job):
+
+        async with self._smtp:
+            return await self.deliver_job(job)
+
+
+class TicketDaemon(object):
+
+    """
+    Long-running alternative to starting a new process from cron for every
+    run. The daemon keeps a TicketGenerator (and so its database
+    connections and persistent cache) for its whole lifetime and generates
+    the notifications for every event schedule due on a given day once the
+    configured run time has passed.
+
+    The last day processed is recorded in a state file so that days missed
+    while the daemon was not running are caught up after a restart. Sending
+    SIGHUP reloads the configuration file; SIGTERM or SIGINT stop the daemon
+    once the current run has finished.
+    """
+
+    # Upper bound on how long the daemon sleeps between checks, so that
+    # clock adjustments (e.g. daylight saving time) are noticed
+    MAX_SLEEP_SECONDS = 60 * 60
+
+    def __init__(self, load_settings):
+
+        self.log = log.getChild(self.__class__.__name__)
+
+        # Callable returning a new Settings object, used again on reload
+        self.load_settings = load_settings
+
+        self.settings = load_settings()
+        self.generator = TicketGenerator(self.settings)
+
+        self._reload_requested = False
+        self._stop_requested = False
+        self._wakeup = threading.Event()
+
+    def request_reload(self, signum=None, frame=None):
+        self.log.info("Configuration reload requested")
+        self._reload_requested = True
+        self._wakeup.set()
+
+    def request_stop(self, signum=None, frame=None):
+        self.log.info("Shutdown requested")
+        self._stop_requested = True
+        self._wakeup.set()
+
+    def reload(self):
+
+        """
+        Re-read the configuration file and replace the ticket generator.
+        If the new configuration cannot be used, the daemon carries on with
+        the current one.
+        """
+
+        self.log.info("Reloading configuration")
+
+        try:
+            settings = self.load_settings()
+            generator = TicketGenerator(settings)
+
+        # Invalid settings have already been logged before sys.exit is
+        # called, which must not take the daemon down
+        except SystemExit:
+            self.log.error("Unable to reload configuration, keeping the current configuration")
+            return
+
+        except Exception as error:
+            self.log.exception("Unable to reload configuration, keeping the current"
+                " configuration: %s", error)
+            return
+
+        self.generator.close()
+        self.settings = settings
+        self.generator = generator
+
+    def read_state(self):
+
+        """
+        Return the last date for which notifications were generated, or None
+        if that is not known
+        """
+
+        try:
+            with open(self.settings.daemon['state_file']) as fh:
+                state = json.load(fh)
+
+            return datetime.date.fromisoformat(state['last_run_date'])
+
+        except FileNotFoundError:
+            return None
+
+        except (ValueError, KeyError, TypeError) as error:
+            self.log.warning("Ignoring unreadable state file %s: %s",
+                self.settings.daemon['state_file'], error)
+            return None
+
+    def write_state(self, run_date):
+
+        """
+        Record the last date for which notifications were generated
+        """
+
+        state_file = self.settings.daemon['state_file']
+        tmp_state_file = state_file + '.tmp'
+
+        with open(tmp_state_file, 'w') as fh:
+            json.dump({'last_run_date': run_date.isoformat()}, fh)
+
+        os.replace(tmp_state_file, state_file)
+
+    def get_run_time(self):
+
+        """
+        Return the configured time of day at which notifications are generated
+        """
+
+        return datetime.datetime.strptime(self.settings.daemon['run_time'], '%H:%M').time()
+
+    def pending_run_dates(self, now):
+
+        """
+        Return the dates whose run time has passed but for which notifications
+        have not been generated yet, oldest first. Without a state file only
+        the most recent date is returned.
+        """
+
+        latest = now.date()
+        if now.time() < self.get_run_time():
+            latest -= datetime.timedelta(days=1)
+
+        earliest = latest - datetime.timedelta(
+            days=max(self.settings.daemon['max_catch_up_days'], 1) - 1)
+
+        last_run_date = self.read_state()
+
+        if last_run_date is None:
+            start = latest
+        else:
+            start = max(last_run_date + datetime.timedelta(days=1), earliest)
+
+            if last_run_date + datetime.timedelta(days=1) < earliest:
+                self.log.warning("Skipping missed dates before %s (max_catch_up_days is %s)",
+                    earliest, self.settings.daemon['max_catch_up_days'])
+
+        return [
+            start + datetime.timedelta(days=offset)
+            for offset in range((latest - start).days + 1)
+        ]
+
+    def seconds_until_next_run(self, now):
+
+        """
+        Return the number of seconds until the next scheduled run time
+        """
+
+        next_run = datetime.datetime.combine(now.date(), self.get_run_time())
+        if next_run <= now:
+            next_run += datetime.timedelta(days=1)
+
+        return (next_run - now).total_seconds()
+
+    def run_pending(self, now=None):
+
+        """
+        Generate notifications for every date which is due in a single
+        batched run, then record the latest date in the state file
+        """
+
+        if now is None:
+            now = datetime.datetime.now()
+
+        run_dates = self.pending_run_dates(now)
+
+        if not run_dates:
+            return
+
+        self.log.info("Running scheduled ticket generation for %s to %s",
+            run_dates[0], run_dates[-1])
+
+        # A failed run (including the library's sys.exit calls on database
+        # errors) must not take the daemon down. The dates are not recorded,
+        # so they are retried at the next wake-up.
+        try:
+            results = self.generator.run_firings(
+                get_schedule_firings(run_dates[0], run_dates[-1]))
+        except (Exception, SystemExit) as error:
+            self.log.exception("Ticket generation for %s to %s failed: %s",
+                run_dates[0], run_dates[-1], error)
+            return
+
+        self.generator.log_summary(results)
+        self.write_state(run_dates[-1])
+
+    def run_forever(self):
+
+        """
+        Main daemon loop
+        """
+
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        self.log.info("Daemon started, generating tickets daily at %s",
+            self.settings.daemon['run_time'])
+
+        while not self._stop_requested:
+
+            self._wakeup.clear()
+
+            if self._reload_requested:
+                self._reload_requested = False
+                self.reload()
+
+            self.run_pending()
+
+            if self._stop_requested:
+                break
+
+            sleep_seconds = min(
+                self.seconds_until_next_run(datetime.datetime.now()),
+                self.MAX_SLEEP_SECONDS)
+
+            self.log.debug("Sleeping for %.0f seconds", sleep_seconds)
+            self._wakeup.wait(sleep_seconds)
+
+        self.generator.close()
+        self.log.info("Daemon stopped")
+
+
+class ConsoleFilterFunc(logging.Filter):
+
+    """
+    Honor boolean flags set within main script config file and only
+    output specific log levels to the console.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        #print("Just proving that this function is being called")
+    def filter(self, record):
+        if self.settings.flags['display_console_error_messages'] and record.levelname == 'ERROR':
+            #print("Error messages enabled")
+            return True
+        if self.settings.flags['display_console_warning_messages'] and record.levelname == 'WARNING':
+            #print("Warning messages enabled")
+            return True
+        if self.settings.flags['display_console_info_messages'] and record.levelname == 'INFO':
+            #print("Info messages enabled")
+            return True
+        if self.settings.flags['display_console_debug_messages'] and record.levelname == 'DEBUG':
+            #print("Debug messages enabled")
+            return True
+        else:
+            #print("No matches")
+            return False
+
+    def lowest_level(self):
+
+        """
+        Return the lowest log level which may be displayed on the console
+        """
+
+        for flag, level in (
+                ('display_console_debug_messages', logging.DEBUG),
+                ('display_console_info_messages', logging.INFO),
+                ('display_console_warning_messages', logging.WARNING),
+                ('display_console_error_messages', logging.ERROR)):
+
+            if self.settings.flags[flag]:
+                return level
+
+        return logging.CRITICAL
+
+
+class LogPayload(object):
+
+    """
+    Wraps a potentially large value (e.g. a rendered email message) passed
+    as a log message argument. Nothing is done unless the record is actually
+    formatted, and then only the first max_chars characters are included
+    along with the total length and a short hash of the full value, so log
+    files do not grow with every wiki page body sent.
+    """
+
+    # Set from the logging section of the config file
+    max_chars = 500
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+
+        value = str(self.value)
+
+        if len(value) <= self.max_chars:
+            return value
+
+        import hashlib
+
+        return "{!r}... [{} chars, sha1 {}]".format(
+            value[:self.max_chars],
+            len(value),
+            hashlib.sha1(value.encode('utf-8', 'replace')).hexdigest()[:12])
+
+#######################################################
+# Functions
+#######################################################
+
+# TODO: Merge this function since we probably do not need a separate function
+# for this.
+def import_mysql_connector():
+
+    """
+    Import the MySQL connector module on first use
+    """
+
+    global mysql
+
+    if mysql is None:
+        log.debug("Attempting to import mysql.connector module")
+        import mysql.connector as mysql_connector
+        mysql = mysql_connector
+
+    return mysql
+
+
+def open_db_connection(settings, database):
+
+    """
+    Open a connection to the database and return a cursor object
+    """
+
+
+    mysql = import_mysql_connector()
+
+    ####################################################################
+    # Open connections to databases
+    ####################################################################
+
+    try:
+
+        log.debug("DB User: %s", settings.mysqldb_config["user"])
+        log.debug("DB Name: %s", database)
+        log.debug("DB Host Name/IP: %s", settings.mysqldb_config["host"])
+        log.debug("DB Host Port: %s", settings.mysqldb_config["port"])
+        log.debug("MySQL - raise_on_warnings: %s",
+            settings.mysqldb_config["raise_on_warnings"])
+        log.debug("MySQL - raise_on_warnings type: %s",
+            type(settings.mysqldb_config["raise_on_warnings"]))
+
+        log.info("Connecting to %s database on %s at port %s",
+            database,
+            settings.mysqldb_config["host"],
+            settings.mysqldb_config["port"])
+
+        mysql_connection = mysql.connect(
+            user=settings.mysqldb_config['user'],
+            password=settings.mysqldb_config['password'],
+            host=settings.mysqldb_config['host'],
+            port=settings.mysqldb_config['port'],
+            database=database,
+            raise_on_warnings=settings.mysqldb_config['raise_on_warnings']
+        )
+
+    except mysql.Error as error:
+        log.exception("Unable to connect to database: %s", error)
+        sys.exit(1)
+
+    return mysql_connection
+
+
+def open_sqlite_database(path):
+
+    """
+    Open the SQLite database used for a local cache or ledger file. The
+    connection is shared by the threads of a run, which serialize their
+    access to it.
+    """
+
+    import sqlite3
+
+    # Several cron jobs may share the same file, so wait for a lock held
+    # by another process instead of failing right away
+    return sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+
+def decode_row(row):
+
+    """
+    Prepared statement cursors may return text columns as bytes or
+    bytearray (depending on the connector version); decode them so rows
+    look the same as those returned by a regular cursor.
+    """
+
+    return tuple(
+        field.decode('utf-8') if isinstance(field, (bytes, bytearray)) else field
+        for field in row
+    )
+
+
+def query_wiki_pages(settings, query_name, wiki_pages, wiki_page_database, db_pool):
+
+    """
+    Run one of the set-based wiki page queries from the config file for
+    several Redmine wiki pages at once. Accepts an iterable of
+    (project, page name) pairs and returns a dictionary mapping each pair
+    that was found to the remaining columns of its result row. A single
+    query is used for all requested pages within the same project.
+    """
+
+    wiki_page_rows = {}
+
+    for wiki_page_project, wiki_page_names, requested_names in group_wiki_pages(wiki_pages):
+
+        wiki_page_titles = pad_parameters(wiki_page_names)
+
+        params = [wiki_page_project] + wiki_page_titles
+
+        query = settings.queries[query_name].format(', '.join(['%s'] * len(wiki_page_titles)))
+
+        log.debug("Wiki pages query (%s): %s", query_name, query)
+        log.debug("Querying %s wiki page(s) from project %s",
+            len(wiki_page_names), wiki_page_project)
+
+        try:
+            log.info('Executing query')
+            rows = db_pool.execute_prepared(wiki_page_database, query, params)
+
+        except Exception as error:
+            log.exception("Unable to execute wiki pages query %s: %s", query_name, error)
+            sys.exit(1)
+
+        for row in rows:
+            wiki_page_title = row[1]
+            for wiki_page_name in requested_names.get(wiki_page_title.lower(), []):
+                wiki_page_rows[(wiki_page_project, wiki_page_name)] = tuple(row[2:])
+
+    return wiki_page_rows
+
+
+def group_wiki_pages(wiki_pages):
+
+    """
+    Group an iterable of (project, page name) pairs by project so that each
+    project can be fetched with one set-based query. Returns a list of
+    (project, sorted page names, requested names) tuples, sorted by project.
+
+    Page titles are compared case-insensitively by the database, so
+    requested names maps each lowercased page name to the names it was
+    requested with, for mapping returned titles back to them.
+    """
+
+    pages_by_project = {}
+    for wiki_page_project, wiki_page_name in wiki_pages:
+        pages_by_project.setdefault(wiki_page_project, set()).add(wiki_page_name)
+
+    project_wiki_pages = []
+
+    for wiki_page_project, wiki_page_names in sorted(pages_by_project.items()):
+
+        wiki_page_names = sorted(wiki_page_names)
+
+        requested_names = {}
+        for wiki_page_name in wiki_page_names:
+            requested_names.setdefault(wiki_page_name.lower(), []).append(wiki_page_name)
+
+        project_wiki_pages.append((wiki_page_project, wiki_page_names, requested_names))
+
+    return project_wiki_pages
+
+
+def pad_parameters(values):
+
+    """
+    Return a copy of a non-empty list of parameter values for an IN (...)
+    list, padded (by repeating the last value) to the next power of two so
+    that only a handful of distinct statements need to be prepared per run
+    """
+
+    marker_count = 1
+    while marker_count < len(values):
+        marker_count *= 2
+
+    return values + [values[-1]] * (marker_count - len(values))
+
+
+def get_wiki_pages_closure(settings, wiki_pages, max_depth, wiki_page_database, db_pool):
+
+    """
+    Retrieve several Redmine wiki pages along with every page they include,
+    directly or through other included pages, up to max_depth levels. The
+    include macro calls are followed by the database (see the
+    wiki_pages_closure query), so a single query is used per project.
+    Experimental: the query has only been checked against a fake database,
+    and it scans the text of every page in the project at each include
+    level.
+
+    Accepts an iterable of (project, page name) pairs and returns a
+    dictionary mapping each (project, page name) pair found to a (version,
+    updated_on, text) tuple. Requested pages are keyed by the name they
+    were requested with, included pages by their Redmine title.
+    """
+
+    wiki_page_rows = {}
+
+    for wiki_page_project, wiki_page_names, requested_names in group_wiki_pages(wiki_pages):
+
+        wiki_page_titles = pad_parameters(wiki_page_names)
+
+        query = settings.queries['wiki_pages_closure'].format(
+            ', '.join(['%s'] * len(wiki_page_titles)))
+
+        # The include macro call is split around the project and page title
+        # so that the literal braces do not need escaping in the query
+        params = [wiki_page_project] + wiki_page_titles + [max_depth, '{{include(', ')}}']
+
+        log.debug("Querying %s wiki page(s) and their included pages from project %s",
+            len(wiki_page_names), wiki_page_project)
+
+        try:
+            log.info('Executing query')
+            rows = db_pool.execute_prepared(wiki_page_database, query, params)
+
+        except Exception as error:
+            log.exception("Unable to execute wiki pages query %s: %s", 'wiki_pages_closure', error)
+            raise
+
+        for wiki_page_identifier, wiki_page_title, version, updated_on, text in rows:
+            for wiki_page_name in requested_names.get(wiki_page_title.lower(), [wiki_page_title]):
+                wiki_page_rows[(wiki_page_project, wiki_page_name)] = \
+                    (version, str(updated_on), text)
+
+        log.debug("Retrieved %s wiki page(s) from project %s", len(rows), wiki_page_project)
+
+    return wiki_page_rows
+
+
+def get_server_version(database, db_pool):
+
+    """
+    Return the version string reported by the database server
+    """
+
+    return db_pool.execute_prepared(database, "SELECT VERSION()", ())[0][0]
+
+
+def supports_recursive_cte(server_version):
+
+    """
+    Whether a server reporting server_version (as returned by SELECT
+    VERSION()) supports WITH RECURSIVE: MySQL 8.0 or later and MariaDB
+    10.2.2 or later
+    """
+
+    # MariaDB versions may be reported behind a "5.5.5-" compatibility prefix
+    match = re.match(r'(?:5\.5\.5-)?(\d+)\.(\d+)\.(\d+)', server_version)
+
+    if match is None:
+        return False
+
+    version = tuple(int(part) for part in match.groups())
+
+    if 'mariadb' in server_version.lower():
+        return version >= (10, 2, 2)
+
+    return version >= (8, 0, 0)
+
+
+def get_wiki_pages_contents(settings, wiki_pages, wiki_page_database, db_pool):
+
+    """
+    Retrieve contents of several Redmine wiki pages at once. Accepts an
+    iterable of (project, page name) pairs and returns a dictionary mapping
+    each pair to the contents of that page. Pages which could not be found
+    are left out, so that events using them fail instead of sending a
+    notification without the page contents.
+    """
+
+    wiki_pages = set(wiki_pages)
+
+    wiki_page_rows = query_wiki_pages(
+        settings, 'wiki_pages_contents', wiki_pages, wiki_page_database, db_pool)
+
+    wiki_pages_contents = {}
+
+    for wiki_page in sorted(wiki_pages):
+
+        wiki_page_content = wiki_page_rows.get(wiki_page, (None,))[0]
+
+        if wiki_page_content is None:
+            log.warning("Unable to retrieve content from %s:%s", *wiki_page)
+            continue
+
+        wiki_pages_contents[wiki_page] = wiki_page_content
+
+    return wiki_pages_contents
+
+
+def get_wiki_pages_versions(settings, wiki_pages, wiki_page_database, db_pool):
+
+    """
+    Retrieve just the version number and last update time of several Redmine
+    wiki pages at once. This is a cheap metadata-only query used to validate
+    locally cached copies of page contents. Pages which could not be found
+    are left out of the returned dictionary.
+    """
+
+    wiki_page_rows = query_wiki_pages(
+        settings, 'wiki_pages_versions', wiki_pages, wiki_page_database, db_pool)
+
+    return {
+        wiki_page: (version, str(updated_on))
+        for wiki_page, (version, updated_on) in wiki_page_rows.items()
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_include_macro_pattern(wiki_page_project):
+
+    """
+    Return the compiled pattern used to match Redmine include macro calls
+    for pages within the specified project. The first parenthesized
+    subgroup matches just the name of the included page. Compiled patterns
+    are cached per project so that they are only built once per run.
+    """
+
+    # NOTE: I could not get the syntax right to support using .format()
+    # so I fell back to using classic string formatting
+    # TODO: Consider moving this to external config file for easy maintenace
+    return re.compile(
+        r'{{include\(%s:([a-zA-Z0-9 _\-\']+)\)}}' % (re.escape(wiki_page_project)))
+
+
+def find_include_calls(wiki_page_contents, wiki_page_project):
+
+    """
+    Scan the contents of a wiki page once and return a list of
+    (start, end, included page name) tuples, one for every include macro
+    call found. The start and end values are the offsets of the complete
+    macro call within the page.
+    """
+
+    include_macro_pattern = get_include_macro_pattern(wiki_page_project)
+
+    return [
+        (match.start(), match.end(), match.group(1))
+        for match in include_macro_pattern.finditer(wiki_page_contents)
+    ]
+
+
+def parse_wiki_page(wiki_page_contents, wiki_page_project):
+
+    """
+    Split the contents of a wiki page into a list of segments. Literal text
+    is kept as strings while every include macro call for the same project
+    becomes a (macro call, included page name) tuple. Joining the macro
+    calls and literal text back together gives the original page.
+    """
+
+    segments = []
+    position = 0
+
+    for start, end, included_page_name in find_include_calls(wiki_page_contents, wiki_page_project):
+        segments.append(wiki_page_contents[position:start])
+        segments.append((wiki_page_contents[start:end], included_page_name))
+        position = end
+
+    segments.append(wiki_page_contents[position:])
+
+    return segments
+
+
+def expand_wiki_page(wiki_page_project, wiki_page_name, wiki_pages_segments, max_depth, expanded_pages=None):
+
+    """
+    Build the fully expanded contents of a wiki page from the parsed
+    segments of that page and of every page it includes (see
+    parse_wiki_page). Include calls which would form a cycle or exceed
+    the maximum include depth are left in place and a warning is logged.
+
+    Expanded pages are memoized in the optional expanded_pages dictionary
+    so that it can be shared between calls.
+    """
+
+    if expanded_pages is None:
+        expanded_pages = {}
+
+    def expand(wiki_page, depth, include_chain):
+
+        """
+        Returns the expanded text of a page along with a flag noting
+        whether any include call below it had to be left unexpanded.
+        Only complete expansions are memoized since a truncated one
+        depends on where in the include tree the page was reached.
+        """
+
+        if wiki_page in expanded_pages:
+            return expanded_pages[wiki_page], False
+
+        parts = []
+        truncated = False
+
+        for segment in wiki_pages_segments[wiki_page]:
+
+            if not isinstance(segment, tuple):
+                parts.append(segment)
+                continue
+
+            macro_call, included_page_name = segment
+            included_page = (wiki_page_project, included_page_name)
+
+            if included_page in include_chain:
+                log.warning("Include cycle detected, leaving %s unexpanded in %s:%s",
+                    macro_call, *wiki_page)
+                parts.append(macro_call)
+                truncated = True
+
+            elif depth >= max_depth:
+                log.warning("Maximum include depth of %s reached, leaving %s unexpanded in %s:%s",
+                    max_depth, macro_call, *wiki_page)
+                parts.append(macro_call)
+                truncated = True
+
+            elif included_page not in wiki_pages_segments:
+                log.warning("Included page %s:%s was not found, leaving %s unexpanded in %s:%s",
+                    wiki_page_project, included_page_name, macro_call, *wiki_page)
+                parts.append(macro_call)
+                truncated = True
+
+            else:
+                included_contents, included_truncated = expand(
+                    included_page, depth + 1, include_chain + (included_page,))
+                parts.append(included_contents)
+                truncated = truncated or included_truncated
+
+        expanded_contents = ''.join(parts)
+
+        if not truncated:
+            expanded_pages[wiki_page] = expanded_contents
+
+        return expanded_contents, truncated
+
+    wiki_page = (wiki_page_project, wiki_page_name)
+
+    return expand(wiki_page, 0, (wiki_page,))[0]
+
+
+
+def format_message(envelope, header, body, footer):
+
+    """
+    Assemble a complete email message from its parts
+    """
+
+    # Note:
+    #
+    #  The spacing should be EXACTLY as shown here. Having one space
+    #  between the envelope and header content results in Redmine adding
+    #  header values (Message-Id for example) directly into the OP
+    return "{}{}\n{}\n{}\n".format(envelope, header, body, footer)
+
+
+def init_render_worker(log_queue, level):
+
+    """
+    Prepare a RenderPool worker process: records at or above level are
+    sent back to the parent process through log_queue
+    """
+
+    app_logger = logging.getLogger(app_name)
+
+    for handler in list(app_logger.handlers):
+        app_logger.removeHandler(handler)
+
+    app_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    app_logger.setLevel(level)
+
+    # The parent process passes the records on to any handlers further up
+    app_logger.propagate = False
+
+
+def render_messages(items, wiki_pages_segments, max_depth):
+
+    """
+    Runs in a RenderPool worker process. Expands the wiki page of every
+    (envelope, footer, (project, page name)) item using the given parsed
+    segments and assembles the message. Returns the list of messages, with
+    the exception raised for an item in place of its message, along with
+    the list of (project, page name) pairs expanded.
+    """
+
+    expanded_pages = {}
+    messages = []
+
+    for envelope, footer, (wiki_page_project, wiki_page_name) in items:
+        try:
+            if (wiki_page_project, wiki_page_name) not in wiki_pages_segments:
+                raise LookupError("Wiki page {}:{} was not found".format(
+                    wiki_page_project, wiki_page_name))
+
+            body = expand_wiki_page(
+                wiki_page_project, wiki_page_name, wiki_pages_segments, max_depth, expanded_pages)
+            messages.append(format_message(envelope, "", body, footer))
+
+        except Exception as error:
+            messages.append(error)
+
+    return messages, list(expanded_pages)
+
+
+def get_select_columns(query):
+
+    """
+    Return the lower case names of the columns in the outermost select list
+    of a query: the alias of each expression or its last identifier. Returns
+    None if the select list could not be found.
+    """
+
+    # Split the text between the outermost SELECT and FROM on commas which
+    # are not inside parentheses or quotes
+    depth = 0
+    quote = None
+    select_start = None
+    columns = []
+
+    for match in re.finditer(r"""'|"|`|\(|\)|,|\bSELECT\b|\bFROM\b""", query, re.IGNORECASE):
+
+        token = match.group(0)
+
+        if quote is not None:
+            if token == quote:
+                quote = None
+
+        elif token in ('\'', '"', '`'):
+            quote = token
+
+        elif token == '(':
+            depth += 1
+
+        elif token == ')':
+            depth -= 1
+
+        elif depth:
+            continue
+
+        elif token.upper() == 'SELECT' and select_start is None:
+            select_start = match.end()
+
+        elif token == ',' and select_start is not None:
+            columns.append(query[select_start:match.start()])
+            select_start = match.end()
+
+        elif token.upper() == 'FROM' and select_start is not None:
+            columns.append(query[select_start:match.start()])
+            break
+
+    else:
+        return None
+
+    names = []
+    for column in columns:
+        name = re.search(r'`?(\w+)`?\s*$', column)
+        names.append(name.group(1).lower() if name else column.strip().lower())
+
+    return names
+
+
+def get_events_query(settings, event_schedule_count):
+
+    """
+    Return the query used to retrieve one chunk of events for the given
+    number of event schedules. The parameters are the event schedule
+    keywords, followed by the highest event id already retrieved and the
+    maximum number of events to return.
+    """
+
+    # Dynamically create the select query used to pull data from MySQL table
+    # See automated_tickets.ini for the available queries
+
+    # Base query that filters just on the event schedule type(s). We may
+    # further constrain depending on what configuration settings have
+    # been toggled. The schedule keywords are passed as bound parameters
+    # of a prepared statement.
+    base_query = "{} AND event_schedule IN ({})".format(
+        settings.queries['event_table_entries'],
+        ', '.join(['%s'] * event_schedule_count))
+
+    # Check configuration setting to determine if we need to filter out
+    # "intern" or student worker events.
+    if not settings.flags['process_intern_events']:
+        query = "{} AND intern_task = 0".format(base_query)
+    else:
+        # Use just the base query then
+        query = base_query
+
+    # Events are retrieved in chunks, ordered by id. Each chunk starts after
+    # the last id of the previous one, so no connection is held open (or
+    # result set kept on the server) between chunks.
+    return "{} AND id > %s ORDER BY id LIMIT %s".format(query)
+
+
+def iter_events(settings, event_schedules, db_pool, chunk_size, invalid_rows=None):
+
+    """
+    Generator yielding lists of at most chunk_size Event objects matching
+    the requested event schedules, so that large numbers of events can be
+    processed with bounded memory. Accepts either a single event schedule
+    keyword or a list of them; the events for all of those schedules are
+    retrieved by the same query. Rows which are not valid events are
+    logged and, if invalid_rows is given, appended to it along with the
+    error so that they can be reported as failures.
+    """
+
+    if isinstance(event_schedules, str):
+        event_schedules = [event_schedules]
+
+    if not event_schedules:
+        log.info("No event schedules requested, skipping events query")
+        return
+
+    query = get_events_query(settings, len(event_schedules))
+
+    # Start below the lowest possible id so that the first chunk includes
+    # every matching event
+    last_event_id = -1
+
+    while True:
+
+        try:
+            log.info("Executing query")
+            rows = db_pool.execute_prepared(
+                settings.mysqldb_config['events_database'],
+                query,
+                list(event_schedules) + [last_event_id, chunk_size])
+
+        except Exception as error:
+            log.exception("Unable to query event_reminders table: %s", error)
+            sys.exit(1)
+
+        log.debug("Pulled %s row(s) from %s MySQL table", len(rows), 'events')
+
+        events = []
+        for row in rows:
+
+            # Collect a list of all events we need to take action for
+            try:
+                events.append(Event(row))
+            except ValueError as error:
+                log.error("Skipping invalid event %s: %s", LogPayload(row), error)
+                if invalid_rows is not None:
+                    invalid_rows.append((row, error))
+
+        if rows:
+            last_event_id = rows[-1][EVENT_FIELDS.index('id')]
+
+        if events:
+            yield events
+
+        if len(rows) < chunk_size:
+            return
+
+
+class Outbox(object):
+
+    """
+    Durable, maildir-style spool of rendered notifications. Each message is
+    written atomically to its own file and later delivered by a separate
+    flush step, so generating tickets never waits on the mail relay and a
+    relay outage does not lose any tickets.
+
+    Layout of the outbox directory:
+
+    * tmp: messages which are still being written
+    * new: messages waiting to be delivered
+    * cur: messages claimed by a flush which is delivering them
+    * failed: messages which could not be delivered after all retries
+    """
+
+    # Claimed messages older than this are assumed to be abandoned
+    STALE_CLAIM_SECONDS = 60 * 60
+
+    def __init__(self, directory, max_attempts, retry_base_seconds):
+
+        self.log = log.getChild(self.__class__.__name__)
+
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+
+        for subdirectory in ('tmp', 'new', 'cur', 'failed'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+    def _path(self, subdirectory, name):
+        return os.path.join(self.directory, subdirectory, name)
+
+    def _write(self, name, entry):
+
+        """
+        Write an entry to tmp and then move it into new. The rename is atomic,
+        so a partially written message is never picked up by a flush.
+        """
+
+        tmp_path = self._path('tmp', name)
+
+        with open(tmp_path, 'w') as fh:
+            json.dump(entry, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        os.rename(tmp_path, self._path('new', name))
+
+    def put(self, from_address, to_address, message):
+
+        """
+        Add a rendered notification to the outbox
+        """
+
+        import uuid
+
+        # Names sort in the order the messages were spooled
+        name = "{:.6f}.{}.{}".format(time.time(), os.getpid(), uuid.uuid4().hex)
+
+        self._write(name, {
+            'from_address': from_address,
+            'to_address': to_address,
+            'message': message,
+            'attempts': 0,
+            'next_attempt': 0,
+        })
+
+        self.log.debug("Spooled notification %s", name)
+
+    def flush(self, notifier):
+
+        """
+        Attempt delivery of every message which is due, using the provided
+        notifier. Messages which fail are retried by later flushes with an
+        exponential backoff until the maximum number of attempts is reached,
+        at which point they are moved to the failed directory.
+
+        Returns a dictionary of counters describing the outcome.
+        """
+
+        results = {
+            'sent': 0,
+            'deferred': 0,
+            'retrying': 0,
+            'failed': 0,
+        }
+
+        now = time.time()
+
+        # Messages left claimed by a flush which never finished (e.g. the
+        # process was killed) are returned to the queue
+        for name in os.listdir(self._path('cur', '')):
+            cur_path = self._path('cur', name)
+            try:
+                if os.path.getmtime(cur_path) < now - self.STALE_CLAIM_SECONDS:
+                    self.log.warning("Requeueing abandoned notification %s", name)
+                    os.rename(cur_path, self._path('new', name))
+            except FileNotFoundError:
+                continue
+
+        for name in sorted(os.listdir(self._path('new', ''))):
+
+            new_path = self._path('new', name)
+            cur_path = self._path('cur', name)
+
+            # Claim the message; if another flush got to it first, skip it
+            try:
+                os.rename(new_path, cur_path)
+            except FileNotFoundError:
+                continue
+
+            with open(cur_path) as fh:
+                entry = json.load(fh)
+
+            if entry['next_attempt'] > now:
+                os.rename(cur_path, new_path)
+                results['deferred'] += 1
+                continue
+
+            try:
+                notifier.send(entry['from_address'], entry['to_address'], entry['message'])
+
+            except Exception as error:
+                entry['attempts'] += 1
+
+                if entry['attempts'] >= self.max_attempts:
+                    self.log.error("Giving up on notification %s after %s attempt(s): %s",
+                        name, entry['attempts'], error)
+                    os.rename(cur_path, self._path('failed', name))
+                    results['failed'] += 1
+
+                else:
+                    delay = self.retry_base_seconds * 2 ** (entry['attempts'] - 1)
+                    entry['next_attempt'] = now + delay
+                    self.log.warning("Unable to deliver notification %s (attempt %s), retrying in %s seconds: %s",
+                        name, entry['attempts'], delay, error)
+                    self._write(name, entry)
+                    os.remove(cur_path)
+                    results['retrying'] += 1
+
+            else:
+                os.remove(cur_path)
+                results['sent'] += 1
+
+        self.log.info("Outbox flush: %s sent, %s deferred, %s retrying, %s failed",
+            results['sent'], results['deferred'], results['retrying'], results['failed'])
+
+        return results
+
+
+@contextlib.contextmanager
+def profiling(output_directory, profile=False, trace_memory=False, top_allocations=25):
+
+    """
+    Optionally profile the body of the with block. With profile enabled the
+    collected cProfile statistics are dumped to a pstats file; with
+    trace_memory enabled a report of the largest allocations (by file and
+    line) still held at the end of the block, along with the peak traced
+    memory, is written to a text file. Both files are written to
+    output_directory and named after the time the block started. Nothing
+    is imported or enabled unless requested.
+    """
+
+    if not (profile or trace_memory):
+        yield
+        return
+
+    file_prefix = os.path.join(
+        output_directory,
+        "{}-{}".format(app_name, datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+    profiler = None
+
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield
+
+    finally:
+
+        if profiler is not None:
+            profiler.disable()
+
+            profile_file = file_prefix + '.pstats'
+            profiler.dump_stats(profile_file)
+
+            log.info("Profile written to %s (view with: python -m pstats %s)",
+                profile_file, profile_file)
+
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current_size, peak_size = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            # Leave out allocations made by the tracing and profiling
+            # machinery itself
+            trace_filters = [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            ]
+            if profiler is not None:
+                trace_filters.append(tracemalloc.Filter(False, cProfile.__file__))
+
+            snapshot = snapshot.filter_traces(trace_filters)
+
+            memory_file = file_prefix + '-memory.txt'
+
+            with open(memory_file, 'w') as fh:
+                fh.write("Peak traced memory: {} bytes\n".format(peak_size))
+                fh.write("Traced memory at end of run: {} bytes\n\n".format(current_size))
+                fh.write("Top {} allocations by file and line:\n\n".format(top_allocations))
+
+                for statistic in snapshot.statistics('lineno')[:top_allocations]:
+                    fh.write("{}\n".format(statistic))
+
+            log.info("Memory allocation report written to %s (peak %s bytes)",
+                memory_file, peak_size)
+
+
+def get_migrations(migrations_directory):
+
+    """
+    Return a sorted list of (version, description, path) tuples for the
+    schema migration files found in the given directory. Migration files
+    are named NNNN_description.sql, where NNNN is the schema version the
+    file brings the database to.
+    """
+
+    migrations = []
+
+    for file_name in os.listdir(migrations_directory):
+
+        match = re.match(r'^(\d+)_(\w+)\.sql$', file_name)
+        if match is None:
+            continue
+
+        migrations.append((
+            int(match.group(1)),
+            match.group(2),
+            os.path.join(migrations_directory, file_name)))
+
+    return sorted(migrations)
+
+
+def split_sql_statements(sql):
+
+    """
+    Split the contents of a migration file into individual statements.
+    Lines starting with -- are treated as comments; statements are
+    separated by a semicolon at the end of a line.
+    """
+
+    lines = [line for line in sql.splitlines() if not line.lstrip().startswith('--')]
+
+    statements = re.split(r';\s*$', '\n'.join(lines), flags=re.M)
+
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def apply_migrations(settings, db_pool, migrations_directory):
+
+    """
+    Apply any schema migrations which have not yet been recorded in the
+    schema_version table of the events database, oldest first. Returns the
+    list of versions applied. Requires an account which is allowed to
+    modify the events database.
+    """
+
+    applied = []
+
+    with db_pool.connection(settings.mysqldb_config['events_database']) as mysql_connection:
+
+        mysql_cursor = mysql_connection.cursor(buffered=True)
+
+        try:
+            # Databases created before migrations were introduced do not
+            # have the table used to track them yet. CREATE TABLE IF NOT
+            # EXISTS would leave a note for an existing table, which fails
+            # the statement when raise_on_warnings is enabled.
+            db_pool.execute(mysql_cursor,
+                "SELECT COUNT(*) FROM information_schema.tables"
+                " WHERE table_schema = DATABASE() AND table_name = 'schema_version'")
+
+            if not mysql_cursor.fetchone()[0]:
+                log.info("Creating schema_version table")
+                db_pool.execute(mysql_cursor,
+                    "CREATE TABLE schema_version ("
+                    " version int(11) NOT NULL,"
+                    " description varchar(255) NOT NULL,"
+                    " applied_on timestamp DEFAULT CURRENT_TIMESTAMP,"
+                    " PRIMARY KEY (version))")
+
+            db_pool.execute(mysql_cursor, "SELECT version FROM schema_version")
+            applied_versions = {row[0] for row in mysql_cursor.fetchall()}
+
+            log.info("Schema migrations already applied: %s", sorted(applied_versions))
+
+            for version, description, path in get_migrations(migrations_directory):
+
+                if version in applied_versions:
+                    continue
+
+                log.info("Applying schema migration %s (%s)", version, description)
+
+                with open(path) as fh:
+                    statements = split_sql_statements(fh.read())
+
+                for statement in statements:
+                    log.debug("Migration statement: %s", statement)
+                    db_pool.execute(mysql_cursor, statement)
+
+                db_pool.execute(mysql_cursor,
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (version, description))
+
+                mysql_connection.commit()
+                applied.append(version)
+
+        except Exception as error:
+            log.exception("Unable to apply schema migrations: %s", error)
+            sys.exit(1)
+
+        finally:
+            mysql_cursor.close()
+
+    log.info("Schema migrations applied by this run: %s", applied)
+
+    return applied
+
+
+def check_queries(settings, db_pool):
+
+    """
+    Run EXPLAIN for each of the configured queries (using placeholder
+    parameter values) and log a warning for every table the server would
+    read with a full scan. Returns the list of (query name, table) pairs
+    which triggered a warning.
+    """
+
+    redmine_database = settings.mysqldb_config['redmine_database']
+    events_database = settings.mysqldb_config['events_database']
+
+    # (query name, database, query, parameters) for every configured query,
+    # built the same way as when the query is used for real
+    event_schedules = list(DATE_LABEL)
+    checks = [
+        ('event_table_entries', events_database,
+            get_events_query(settings, len(event_schedules)),
+            event_schedules + [-1, settings.workers['chunk_size']]),
+        ('wiki_pages_contents', redmine_database,
+            settings.queries['wiki_pages_contents'].format('%s'),
+            ('project', 'WikiStart')),
+    ]
+
+    if 'wiki_pages_versions' in settings.queries:
+        checks.append(
+            ('wiki_pages_versions', redmine_database,
+                settings.queries['wiki_pages_versions'].format('%s'),
+                ('project', 'WikiStart')))
+
+    if settings.include_macros['server_side_resolver'] and 'wiki_pages_closure' in settings.queries:
+        checks.append(
+            ('wiki_pages_closure', redmine_database,
+                settings.queries['wiki_pages_closure'].format('%s'),
+                ('project', 'WikiStart', settings.include_macros['max_depth'], '{{include(', ')}}')))
+
+    full_scans = []
+
+    for query_name, database, query, params in checks:
+
+        with db_pool.cursor(database, dictionary=True) as mysql_cursor:
+
+            try:
+                db_pool.execute(mysql_cursor, "EXPLAIN " + query, params)
+                plan = mysql_cursor.fetchall()
+
+            except Exception as error:
+                log.exception("Unable to EXPLAIN query %s: %s", query_name, error)
+                sys.exit(1)
+
+        for step in plan:
+
+            log.debug("Query plan for %s: %s", query_name, step)
+
+            # Derived tables (such as the rows of a recursive query) only
+            # exist while the query runs and have no indexes to use
+            if step.get('type') == 'ALL' and not str(step.get('table')).startswith('<'):
+                log.warning("Query %s reads table %s with a full scan (about %s rows)",
+                    query_name, step.get('table'), step.get('rows'))
+                full_scans.append((query_name, step.get('table')))
+
+        if not any(name == query_name for name, table in full_scans):
+            log.info("Query %s uses indexes for every table", query_name)
+
+    return full_scans
+
+
+def get_date_labels(day):
+
+    """
+    Return the equivalent of DATE_LABEL for the given date
+    """
+
+    return {
+        event_schedule: day.strftime(date_format)
+        for event_schedule, date_format in DATE_LABEL_FORMAT.items()
+    }
+
+
+def get_due_schedules(day):
+
+    """
+    Return the list of event schedule keywords which fire on the given date
+    """
+
+    return [
+        event_schedule for event_schedule in DATE_LABEL
+        if SCHEDULE_CALENDAR[event_schedule](day)
+    ]
+
+
+def get_schedule_firings(start, end):
+
+    """
+    Return a list of (date, event schedules) pairs, oldest first, for every
+    date between start and end (inclusive) on which at least one event
+    schedule fires
+    """
+
+    firings = []
+
+    day = start
+    while day <= end:
+        event_schedules = get_due_schedules(day)
+        if event_schedules:
+            firings.append((day, event_schedules))
+        day += datetime.timedelta(days=1)
+
+    return firings
+
+
+def get_firing_days(firings):
+
+    """
+    Return a list of (event schedules, date labels) pairs for a list of
+    (date, event schedules) pairs such as the one returned by
+    get_schedule_firings, as expected by TicketGenerator.get_jobs
+    """
+
+    return [
+        (day_event_schedules, get_date_labels(run_date))
+        for run_date, day_event_schedules in firings
+    ]
+
+
+def process_event_safely(handler, event, *args):
+
+    """
+    Call handler for a single event (followed by any other arguments) and
+    return the exception raised, if any, so that one failing event does not
+    stop the others.
+    """
+
+    try:
+        handler(event, *args)
+    except Exception as error:
+        log.exception("Unable to process event for wiki page %s:%s: %s",
+            event.redmine_wiki_page_project_shortname,
+            event.redmine_wiki_page_name,
+            error)
+        return error
+
+    return None
+
+
+def process_events(jobs, handler, executor=None):
+
+    """
+    Call handler with the event, date labels and (possibly not yet
+    rendered) message of every Job, either one at a time or, if an
+    executor is given, using its worker threads. The executor is left
+    running so that it can be reused for the next chunk of jobs. Returns
+    a list of (job, error) pairs in the same order as the jobs were given,
+    where error is the exception raised while handling that job or None if
+    it was handled successfully.
+    """
+
+    def process_job(job):
+        return process_event_safely(handler, job.event, job.date_labels, job.email_message)
+
+    if executor is None:
+        errors = [process_job(job) for job in jobs]
+
+    else:
+        errors = list(executor.map(process_job, jobs))
+
+    return list(zip(jobs, errors))
+
+
+# FIXME: Add the from_address and to_address values onto the message object
+def send_notification(settings, from_address, to_address, message):
+    """
+    Long term, this should be an entry point to a validation and notification
+    chain of functions, supporting email, text, XMPP and other types
+    of notifications. For now, only email notifications are supported.
+
+    NOTE: This opens (and closes) a new SMTP session for every call. Use an
+    EmailNotifier when sending more than one notification.
+    """
 
-        server = smtplib.SMTP(email_server)
-        #server.set_debuglevel(1)
-        server.sendmail(from_address, to_address, message)
-        server.quit()
+    with EmailNotifier(settings) as notifier:
+        notifier.send(from_address, to_address, message)
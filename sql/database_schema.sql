@@ -99,9 +99,40 @@ CREATE TABLE `event_reminders`.`events`
 
   `last_modified` timestamp DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   `comments` text NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+
+  /* Covers the filters used by the event_table_entries query. Added by
+     sql/migrations/0001_events_schedule_lookup_index.sql */
+  INDEX `events_schedule_lookup` (`event_schedule`, `enabled`, `intern_task`)
 )
     ENGINE=InnoDB
     DEFAULT CHARSET=utf8
     COMMENT="Milestone one design for automated_tickets project. This table represents various events and tasks that we should receive notifications for."
 ;
+
+
+
+-- Tracks which of the migrations in the sql/migrations directory have been
+-- applied. A new database created from this file already includes every
+-- migration listed below. Existing databases are brought up to date by
+-- running automated_tickets.py with the --apply_migrations option.
+CREATE TABLE `event_reminders`.`schema_version`
+(
+  `version` int(11) NOT NULL
+    COMMENT "The numeric prefix of the migration file name",
+
+  `description` varchar(255) NOT NULL
+    COMMENT "The remainder of the migration file name",
+
+  `applied_on` timestamp DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+)
+    ENGINE=InnoDB
+    DEFAULT CHARSET=utf8
+    COMMENT="Schema migrations applied to this database"
+;
+
+INSERT INTO `event_reminders`.`schema_version` (`version`, `description`)
+VALUES
+    (1, 'events_schedule_lookup_index')
+;
@@ -0,0 +1,11 @@
+-- Purpose: Add a composite index covering the filters applied to the
+-- event_table_entries query (see automated_tickets.ini) so that looking up
+-- the events for one or more event schedules no longer scans the whole
+-- events table.
+--
+-- The event_schedule column comes first as it is the most selective of the
+-- three; the enabled and intern_task flags are added so that the complete
+-- WHERE clause can be resolved from the index.
+
+CREATE INDEX `events_schedule_lookup`
+    ON `events` (`event_schedule`, `enabled`, `intern_task`);
@@ -0,0 +1,313 @@
+"""
+Exercises AsyncTicketEngine against local async fakes of the events
+database, the Redmine database and the mail relay. Run with:
+
+    python -m unittest discover tests
+"""
+
+import asyncio
+import collections
+import contextlib
+import datetime
+import os
+import sys
+import threading
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import automated_tickets_lib as atlib
+
+
+FIRINGS = [(datetime.date(2024, 1, 15), ['daily'])]
+
+
+def make_event(event_id, project):
+
+    return atlib.Event((
+        event_id,
+        'to@example.com',
+        'from@example.com',
+        'Task {}',
+        'Page{}'.format(event_id % 3),
+        project,
+        project,
+        'Category',
+        'Assigned',
+        None,
+        'Normal',
+        'daily',
+    ))
+
+
+def make_chunks(chunk_count, chunk_size, projects):
+
+    return [
+        [
+            make_event(event_id, projects[event_id % len(projects)])
+            for event_id in range(chunk * chunk_size, (chunk + 1) * chunk_size)
+        ]
+        for chunk in range(chunk_count)
+    ]
+
+
+class FakeGenerator(object):
+
+    """
+    Stands in for TicketGenerator, providing only what the engine uses
+    """
+
+    def __init__(self):
+
+        self.settings = types.SimpleNamespace(workers={'chunk_size': 10})
+        self.db_pool = None
+        self.invalid_rows = []
+        self.metrics = atlib.RunMetrics()
+        self.render_pool = None
+
+        self.unloaded = []
+        self.lock = threading.Lock()
+        self.load_threads = set()
+        self.delivery_threads = set()
+        self.get_jobs_threads = set()
+
+    def get_jobs(self, days, events):
+
+        with self.lock:
+            self.get_jobs_threads.add(threading.get_ident())
+
+        return [
+            atlib.Job(date_labels, event)
+            for day_event_schedules, date_labels in days
+            for event in events
+            if event.event_schedule in day_event_schedules
+        ]
+
+    def load_jobs(self, jobs):
+
+        with self.lock:
+            self.load_threads.add(threading.get_ident())
+
+        time.sleep(0.005)
+
+        return {
+            (job.event.redmine_wiki_page_project_shortname, job.event.redmine_wiki_page_name)
+            for job in jobs
+        }
+
+    def unload_jobs(self, primary_wiki_pages):
+
+        self.unloaded.append(primary_wiki_pages)
+
+    def process_event(self, event, date_labels, email_message=None):
+
+        with self.lock:
+            self.delivery_threads.add(threading.get_ident())
+
+        time.sleep(0.002)
+
+        if event.id % 7 == 3:
+            raise ValueError("Relay rejected event {}".format(event.id))
+
+
+class FakeEngine(atlib.AsyncTicketEngine):
+
+    """
+    Engine whose events database, Redmine database and mail relay are
+    local async fakes recording how many calls are in progress at once
+    """
+
+    def __init__(self, generator, chunks, redmine_db_limit, smtp_limit):
+
+        super().__init__(generator, redmine_db_limit, smtp_limit)
+
+        self.chunks = iter(chunks)
+
+        self.active = collections.Counter()
+        self.peak = collections.Counter()
+
+        # Resources in use at the same time as each resource
+        self.overlaps = collections.defaultdict(set)
+
+        self.events = []
+
+    @contextlib.asynccontextmanager
+    async def using(self, resource):
+
+        self.active[resource] += 1
+        self.peak[resource] = max(self.peak[resource], self.active[resource])
+
+        try:
+            await asyncio.sleep(0.002)
+            for other, count in self.active.items():
+                if count and other != resource:
+                    self.overlaps[resource].add(other)
+                    self.overlaps[other].add(resource)
+            yield
+        finally:
+            self.active[resource] -= 1
+
+    async def fetch_events(self):
+
+        async with self.using('events_db'):
+            events = next(self.chunks, None)
+
+        self.events.append(('fetched', None if events is None else events[0].id))
+
+        return events
+
+    async def load_wiki_pages(self, jobs):
+
+        async with self.using('redmine_db'):
+            return {
+                (job.event.redmine_wiki_page_project_shortname, job.event.redmine_wiki_page_name)
+                for job in jobs
+            }
+
+    async def deliver_job(self, job):
+
+        async with self.using('smtp'):
+            if job.event.id % 7 == 3:
+                return ValueError("Relay rejected event {}".format(job.event.id))
+
+        self.events.append(('delivered', job.event.id))
+
+        return None
+
+
+class AsyncTicketEngineTests(unittest.TestCase):
+
+    def run_fake_engine(self, chunks, redmine_db_limit=2, smtp_limit=3):
+
+        generator = FakeGenerator()
+        engine = FakeEngine(generator, chunks, redmine_db_limit, smtp_limit)
+
+        processed_events, failed_events = engine.run(FIRINGS, ['daily'])
+
+        return generator, engine, processed_events, failed_events
+
+    def test_limits_are_applied_to_each_resource(self):
+
+        chunks = make_chunks(4, 12, ['alpha', 'beta', 'gamma', 'delta'])
+
+        generator, engine, processed_events, failed_events = self.run_fake_engine(
+            chunks, redmine_db_limit=2, smtp_limit=3)
+
+        self.assertEqual(engine.peak['events_db'], 1)
+        self.assertEqual(engine.peak['redmine_db'], 2)
+        self.assertEqual(engine.peak['smtp'], 3)
+
+    def test_wiki_pages_are_loaded_while_delivering(self):
+
+        chunks = make_chunks(4, 12, ['alpha', 'beta'])
+
+        generator, engine, processed_events, failed_events = self.run_fake_engine(chunks)
+
+        self.assertIn('smtp', engine.overlaps['redmine_db'])
+        self.assertIn('smtp', engine.overlaps['events_db'])
+
+    def test_projects_are_delivered_while_others_load(self):
+
+        class OverlappingEngine(FakeEngine):
+
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.delivered = asyncio.Event()
+
+            async def load_wiki_pages(self, jobs):
+
+                # Only finishes once a job of the other project has been
+                # delivered, which would never happen if deliveries waited
+                # for the whole chunk to be loaded
+                if jobs[0].event.redmine_wiki_page_project_shortname == 'beta':
+                    await asyncio.wait_for(self.delivered.wait(), 5)
+
+                return await super().load_wiki_pages(jobs)
+
+            async def deliver_job(self, job):
+
+                error = await super().deliver_job(job)
+                self.delivered.set()
+                return error
+
+        chunks = make_chunks(1, 20, ['alpha', 'beta'])
+
+        generator = FakeGenerator()
+        engine = OverlappingEngine(generator, chunks, 2, 3)
+
+        processed_events, failed_events = engine.run(FIRINGS, ['daily'])
+
+        self.assertEqual(processed_events, 20)
+
+    def test_every_event_is_reported(self):
+
+        chunks = make_chunks(3, 10, ['alpha', 'beta'])
+
+        generator, engine, processed_events, failed_events = self.run_fake_engine(chunks)
+
+        self.assertEqual(processed_events, 30)
+        self.assertEqual(
+            [event.id for event, error in failed_events],
+            [event.id for chunk in chunks for event in chunk if event.id % 7 == 3])
+
+        for event, error in failed_events:
+            self.assertIsInstance(error, ValueError)
+
+    def test_chunks_are_unloaded_once_delivered(self):
+
+        chunks = make_chunks(3, 6, ['alpha', 'beta'])
+
+        generator, engine, processed_events, failed_events = self.run_fake_engine(chunks)
+
+        self.assertEqual(generator.unloaded, [
+            {
+                (event.redmine_wiki_page_project_shortname, event.redmine_wiki_page_name)
+                for event in chunk
+            }
+            for chunk in chunks
+        ])
+
+        # The chunk after next is only fetched once a chunk has been
+        # delivered, so no more than two chunks are held at once
+        last_delivery = max(
+            engine.events.index(('delivered', event.id))
+            for event in chunks[0] if event.id % 7 != 3)
+        self.assertGreater(engine.events.index(('fetched', chunks[2][0].id)), last_delivery)
+
+    def test_executors_are_sized_to_the_limits(self):
+
+        # Only the events database is faked here, so the engine's own
+        # executors call the generator from worker threads
+        class EventsOnlyEngine(atlib.AsyncTicketEngine):
+
+            def __init__(self, generator, chunks, redmine_db_limit, smtp_limit):
+                super().__init__(generator, redmine_db_limit, smtp_limit)
+                self.chunks = iter(chunks)
+
+            async def fetch_events(self):
+                return next(self.chunks, None)
+
+        chunks = make_chunks(3, 20, ['alpha', 'beta', 'gamma', 'delta'])
+
+        generator = FakeGenerator()
+        engine = EventsOnlyEngine(generator, chunks, redmine_db_limit=2, smtp_limit=1)
+
+        processed_events, failed_events = engine.run(FIRINGS, ['daily'])
+
+        self.assertEqual(processed_events, 60)
+        self.assertLessEqual(len(generator.load_threads), 2)
+
+        # Ledger lookups are made away from the event loop
+        self.assertNotIn(threading.get_ident(), generator.get_jobs_threads)
+
+        # One delivery thread, and so at most one SMTP session
+        self.assertEqual(len(generator.delivery_threads), 1)
+        self.assertEqual(
+            [event.id for event, error in failed_events],
+            [event.id for chunk in chunks for event in chunk if event.id % 7 == 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
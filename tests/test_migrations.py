@@ -0,0 +1,139 @@
+"""
+Exercises apply_migrations against a fake events database which, like
+mysql-connector with raise_on_warnings enabled, fails any statement that
+leaves a warning or note behind. Run with:
+
+    python -m unittest discover tests
+"""
+
+import contextlib
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import automated_tickets_lib as atlib
+
+
+MIGRATIONS_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql', 'migrations')
+
+
+class FakeWarning(Exception):
+    pass
+
+
+class FakeCursor(object):
+
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def execute(self, query, params=None):
+
+        database = self.database
+        database.statements.append(query)
+
+        if 'information_schema.tables' in query:
+            self.rows = [(1 if 'schema_version' in database.tables else 0,)]
+
+        elif query.startswith('CREATE TABLE'):
+            table = re.search(r'(\w+) \(', query).group(1)
+            if table in database.tables:
+                # MySQL answers with note 1050 for CREATE TABLE IF NOT
+                # EXISTS, which raise_on_warnings turns into an error
+                raise FakeWarning("1050 (42S01): Table '{}' already exists".format(table))
+            database.tables[table] = []
+
+        elif query.startswith('SELECT version FROM schema_version'):
+            self.rows = [(version,) for version, description in database.tables['schema_version']]
+
+        elif query.startswith('INSERT INTO schema_version'):
+            database.tables['schema_version'].append(tuple(params))
+
+        elif query.startswith('CREATE INDEX'):
+            index = re.search(r'CREATE INDEX `(\w+)`', query).group(1)
+            if index in database.indexes:
+                raise FakeWarning("1061 (42000): Duplicate key name '{}'".format(index))
+            database.indexes.add(index)
+
+        else:
+            raise AssertionError("Unexpected statement: {}".format(query))
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeDatabase(object):
+
+    """
+    Stands in for both the connection pool and the events database
+    """
+
+    def __init__(self, tables=None, indexes=()):
+        self.tables = tables or {}
+        self.indexes = set(indexes)
+        self.statements = []
+
+    @contextlib.contextmanager
+    def connection(self, database):
+        yield self
+
+    def cursor(self, buffered=False):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def execute(self, mysql_cursor, query, params=None):
+        mysql_cursor.execute(query, params)
+
+
+class ApplyMigrationsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = type('Settings', (), {
+            'mysqldb_config': {'events_database': 'event_reminders'},
+        })()
+
+    def apply(self, database):
+        return atlib.apply_migrations(self.settings, database, MIGRATIONS_DIRECTORY)
+
+    def test_database_without_schema_version_table(self):
+
+        database = FakeDatabase()
+
+        self.assertEqual(self.apply(database), [1])
+        self.assertEqual(database.tables['schema_version'], [(1, 'events_schedule_lookup_index')])
+
+    def test_rerun_applies_nothing(self):
+
+        database = FakeDatabase()
+
+        self.apply(database)
+
+        self.assertEqual(self.apply(database), [])
+        self.assertEqual(len(database.tables['schema_version']), 1)
+
+    def test_database_created_from_current_schema(self):
+
+        # sql/database_schema.sql creates the table and records version 1
+        database = FakeDatabase(
+            tables={'schema_version': [(1, 'events_schedule_lookup_index')]},
+            indexes={'events_schedule_lookup'})
+
+        self.assertEqual(self.apply(database), [])
+        self.assertFalse(any(
+            statement.startswith('CREATE') for statement in database.statements))
+
+
+if __name__ == '__main__':
+    unittest.main()